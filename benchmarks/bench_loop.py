@@ -0,0 +1,138 @@
+"""
+Benchmark - event loops (asyncio/uvloop) and client transports (stream/protocol)
+
+Runs the proxy against a local echo server (standing in for the Growatt server)
+and a simulated fleet of dataloggers. Every datalogger sends keep-alive and live
+data frames and waits for each frame to come back through the proxy.
+
+Reports connections/sec (connect + first frame round trip) and the per-frame
+round trip latency for every available loop and transport.
+
+    python benchmarks/bench_loop.py [-d <dataloggers>] [-f <frames per datalogger>]
+                                    [--loop asyncio|uvloop] [--transport stream|protocol]
+"""
+
+import asyncio
+import logging
+import os
+import random
+import struct
+import sys
+from argparse import ArgumentParser
+from statistics import median
+from time import perf_counter
+from libscrc import modbus
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+""" grott_async from this checkout (no install needed) """
+from grott_async.grottproxy_async import AsyncProxyServer, GrottClientProtocol
+from grott_async.utils import GrottProxyConfig, setup_event_loop
+from grott_async.utils.packet_builder import encrypt
+
+BACKLOG = 4096
+""" All dataloggers connect at once """
+
+
+def build_frame(logger_sn: bytes, packet_type: int, body: bytes) -> bytes:
+    payload = encrypt(logger_sn + bytes(20) + body)
+    frame = struct.pack('>HHHH', 1, 6, len(payload) + 2, packet_type) + payload
+    return frame + struct.pack('>H', modbus(frame))
+
+
+def keep_alive(logger_sn: bytes) -> bytes:
+    return build_frame(logger_sn, 0x0116, b'')
+
+
+def live_data(logger_sn: bytes, rnd: random.Random) -> bytes:
+    """ LIVE_DATA with 2 sections of 125 registers (registers 0-249) """
+    body = b'RJE3A22419' + bytes(61 - 8 - 40) + bytes([22, 10, 17, 12, 30, 45])
+    body += bytes([2]) + struct.pack('>hh', 0, 124) + bytes(rnd.randrange(256) for _ in range(250))
+    body += struct.pack('>hh', 125, 249) + bytes(rnd.randrange(256) for _ in range(250))
+    return build_frame(logger_sn, 0x0104, body)
+
+
+async def echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """ Growatt server replacement """
+    while True:
+        data = await reader.read(2 ** 16)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def datalogger(idx: int, port: int, frames: int, connected: list, latencies: list):
+    rnd = random.Random(idx)
+    logger_sn = f'BENCH{idx:05d}'.encode()
+    packets = [keep_alive(logger_sn), live_data(logger_sn, rnd)]
+    start = perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(packets[0])
+    await reader.readexactly(len(packets[0]))
+    connected.append(perf_counter() - start)
+    for i in range(frames):
+        frame = packets[i % 2]
+        start = perf_counter()
+        writer.write(frame)
+        await reader.readexactly(len(frame))
+        latencies.append(perf_counter() - start)
+    writer.close()
+
+
+async def run_fleet(dataloggers: int, frames: int, transport: str) -> dict:
+    upstream = await asyncio.start_server(echo, '127.0.0.1', 0, backlog=BACKLOG)
+    config = GrottProxyConfig('')
+    config.growatt_srv = '127.0.0.1'
+    config.growatt_port = upstream.sockets[0].getsockname()[1]
+    config.load_plugins()
+    proxy = AsyncProxyServer(config)
+    if transport == 'protocol':
+        server = await asyncio.get_running_loop().create_server(lambda: GrottClientProtocol(proxy), '127.0.0.1', 0,
+                                                                backlog=BACKLOG)
+    else:
+        server = await asyncio.start_server(proxy.proxy_factory, '127.0.0.1', 0, backlog=BACKLOG)
+    port = server.sockets[0].getsockname()[1]
+
+    connected = []
+    latencies = []
+    start = perf_counter()
+    await asyncio.gather(*[datalogger(x, port, frames, connected, latencies) for x in range(dataloggers)])
+    elapsed = perf_counter() - start
+    while proxy.clients:
+        """ Let the proxy clients and the echo handlers finish """
+        await asyncio.sleep(0.05)
+    server.close()
+    upstream.close()
+    await server.wait_closed()
+    await upstream.wait_closed()
+    latencies.sort()
+    return {
+        'conn_s': dataloggers / max(connected),
+        'frames_s': len(latencies) / elapsed,
+        'p50': median(latencies),
+        'p99': latencies[int(len(latencies) * 0.99) - 1],
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-d', '--dataloggers', type=int, default=200)
+    parser.add_argument('-f', '--frames', type=int, default=100)
+    parser.add_argument('--loop', choices=('asyncio', 'uvloop'), action='append')
+    parser.add_argument('--transport', choices=('stream', 'protocol'), action='append')
+    options = parser.parse_args()
+    logging.getLogger('grott').setLevel(logging.ERROR)
+
+    print(f'{"loop":>8} | {"transport":>9} | {"conn/s":>8} | {"frames/s":>9} | {"p50 (ms)":>8} | {"p99 (ms)":>8}')
+    for name in options.loop or ('asyncio', 'uvloop'):
+        if setup_event_loop(name) != name:
+            print(f'{name:>8} | not available')
+            continue
+        for transport in options.transport or ('stream', 'protocol'):
+            res = asyncio.run(run_fleet(options.dataloggers, options.frames, transport))
+            print(f'{name:>8} | {transport:>9} | {res["conn_s"]:8.0f} | {res["frames_s"]:9.0f} | '
+                  f'{res["p50"] * 1000:8.3f} | {res["p99"] * 1000:8.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark - Growatt (un)masking
+
+Compares the old per-byte generator implementation with the table driven
+xor_mask (integer and numpy paths) for typical packet sizes.
+
+    python benchmarks/bench_mask.py [-n <iterations>]
+"""
+
+import os
+import sys
+import timeit
+from argparse import ArgumentParser
+from itertools import cycle
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+""" grott_async from this checkout (no install needed) """
+from grott_async.utils import packet
+from grott_async.utils.packet import GrottConstants, xor_mask
+
+
+def legacy_mask(data: bytes) -> bytes:
+    """ The implementation used before xor_mask """
+    mask = cycle(GrottConstants.MASK)
+    return bytes(bytearray([x ^ next(mask) for x in data]))
+
+
+def int_mask(data: bytes) -> bytes:
+    """ xor_mask with the numpy path disabled """
+    length = len(data)
+    masked = int.from_bytes(data, 'little') ^ (packet._MASK_INT & ((1 << (length << 3)) - 1))
+    return masked.to_bytes(length, 'little')
+
+
+def numpy_mask(data: bytes) -> bytes:
+    """ xor_mask numpy path regardless of the size """
+    np = packet.numpy
+    return np.bitwise_xor(np.frombuffer(data, dtype=np.uint8), packet._MASK_ARRAY[:len(data)]).tobytes()
+
+
+def bench(iterations: int):
+    sizes = [30, 96, 256, 580, 1024, 4096, 16384]
+    variants = [('legacy', legacy_mask), ('int', int_mask), ('xor_mask', xor_mask)]
+    if packet.numpy is not None:
+        variants.insert(2, ('numpy', numpy_mask))
+    else:
+        print('numpy not installed. Skipping the numpy path')
+
+    print(f'{"size":>8} | ' + ' | '.join(f'{name + " us":>12}' for name, _ in variants) + f' | {"speedup":>8}')
+    for size in sizes:
+        data = os.urandom(size)
+        expected = legacy_mask(data)
+        results = []
+        for name, func in variants:
+            assert func(data) == expected, f'{name} output differs for {size} bytes'
+            per_call = timeit.timeit(lambda: func(data), number=iterations) / iterations
+            results.append(per_call * 1e6)
+        print(f'{size:>8} | ' + ' | '.join(f'{x:>12.2f}' for x in results) + f' | {results[0] / results[-1]:>7.1f}x')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser('bench_mask')
+    parser.add_argument('-n', '--iterations', type=int, default=2000)
+    bench(parser.parse_args().iterations)
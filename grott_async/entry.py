@@ -2,8 +2,9 @@ import asyncio
 import logging
 import os
 from argparse import ArgumentParser
-from .utils import GrottProxyConfig, GrottLogger
+from .utils import GrottProxyConfig, GrottLogger, setup_event_loop, EVENT_LOOPS, TRACE_LOGGER
 from .grottproxy_async import AsyncProxyServer
+from .workers import GrottWorkerSupervisor
 
 
 def async_proxy():
@@ -11,6 +12,10 @@ def async_proxy():
     parser.add_argument('-c', '--config', required=False, default='grott_async.ini',
                         help='Config path (relative to work-dir if used)')
     parser.add_argument('-w', '--work-dir', required=False)
+    parser.add_argument('--workers', required=False, type=int,
+                        help='Worker processes sharing the listen port (overrides the config)')
+    parser.add_argument('--loop', required=False, choices=EVENT_LOOPS,
+                        help='Event loop (overrides the config)')
     options = parser.parse_args()
     if options.work_dir:
         dir = options.work_dir
@@ -22,7 +27,19 @@ def async_proxy():
 
     """ Parse the INI file, load all dynamic plugins and start the main loop """
     config = GrottProxyConfig(options.config)
-    logger = GrottLogger(output=config.log_to, level=config.log_level, fname=config.log_file)
+    logger = GrottLogger(output=config.log_to, level=config.log_level, fname=config.log_file,
+                         queue_size=config.log_queue)
+    if config.trace_file:
+        trace_logger = GrottLogger(output='file', level='debug', fname=config.trace_file, logger_name=TRACE_LOGGER)
+    if options.loop:
+        config.event_loop = options.loop
+    setup_event_loop(config.event_loop)
+    workers = options.workers or config.workers
+    if workers > 1:
+        """ The workers parse the config and load the plugins on their own """
+        supervisor = GrottWorkerSupervisor(options.config, workers, event_loop=config.event_loop)
+        asyncio.run(supervisor.main())
+        return
     config.load_plugins()
     log = logging.getLogger('grott')
     log.debug(config)
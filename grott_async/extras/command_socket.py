@@ -1,36 +1,58 @@
 import asyncio
 from asyncio.base_events import Server
-from typing import Optional
+from typing import Dict, List, Optional
 import uuid
 from logging import getLogger
 import struct
+from time import monotonic
 from grott_async.utils.packet_builder import ReadHoldingV5, ReadHoldingV6, SetHoldingV5, SetHoldingV6
 from grott_async.utils.packet import GrottRawPacket
+from grott_async.utils.reaper import GrottIdleReaper
+from grott_async.utils.metrics import merge_expositions
 
 log = getLogger('grott')
 
+CMD_HOST = '127.0.0.1'
+CMD_PORT = 15279
+
+
+def worker_cmd_port(worker_id: int) -> int:
+    """ Command socket port of a worker process (multi-process mode) """
+    return CMD_PORT + 1 + worker_id
+
 
 class GrottCMDSocket:
 
-    def __init__(self, proxy):
+    def __init__(self, proxy, port: int = CMD_PORT, reaper: GrottIdleReaper = None):
+        """
+        :param proxy: AsyncProxyServer
+        :param port: Listen port (127.0.0.1)
+        :param reaper: Idle reaper for the connections. A new one is started if not provided
+        """
         from grott_async.grottproxy_async import AsyncProxyServer
         proxy: AsyncProxyServer
         self.server: Server = None  # noqa
         self.clients = {}
         self.proxy = proxy
+        self.port = port
+        self.reaper = reaper if reaper is not None else GrottIdleReaper()
+        self._own_reaper = reaper is None
 
     async def stop(self):
         await self.server.wait_closed()
 
     async def start(self):
 
-        self.server = await asyncio.start_server(self._factory, host='127.0.0.1', port='15279')
-        log.debug('Command endpoint listening on (127.0.0.1, 15279)')
+        self.server = await asyncio.start_server(self._factory, host=CMD_HOST, port=self.port)
+        log.debug(f'Command endpoint listening on ({CMD_HOST}, {self.port})')
+        reaper_task = asyncio.get_running_loop().create_task(self.reaper.run()) if self._own_reaper else None
         async with self.server:
             try:
                 await self.server.serve_forever()
             except asyncio.CancelledError:
                 pass
+        if reaper_task:
+            reaper_task.cancel()
 
     async def _factory(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         """
@@ -40,15 +62,20 @@ class GrottCMDSocket:
         :param writer: Will be provided by the server
         :return:
         """
-        cl = CMDSockClient(reader, writer, self)
+        cl = self._new_client(reader, writer)
         self.clients.update({cl.id: cl})
+        self.reaper.watch(cl.id, cl.idle_timeout, cl.last_activity, cl.writer.close)
         log.debug(f'Client <{cl.id}> connected')
         loop = asyncio.get_running_loop()
         loop.create_task(cl.run())
 
+    def _new_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> 'CMDSockClient':
+        return CMDSockClient(reader, writer, self)
+
     def remove_client(self, cl):
         cl: CMDSockClient
         self.clients.pop(cl.id)
+        self.reaper.forget(cl.id)
 
     def list_proxy_clients(self):
         """
@@ -66,14 +93,27 @@ class GrottCMDSocket:
         """
         return self.proxy.get_client(logger_sn)
 
+    async def proxy_metrics(self) -> str:
+        """ Metrics of the proxy in the Prometheus text format """
+        return await self.proxy.render_metrics()
+
 
 class CMDSockClient:
 
+    idle_timeout = 30
+    """ Seconds without a command before the connection is closed """
+
     def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server: GrottCMDSocket):
         self.reader = reader
         self.writer = writer
         self.server = server
         self.id = str(uuid.uuid4())
+        self.last_read = monotonic()
+        self._busy = False
+        """ A command is running (the inverter response may take a while) """
+
+    def last_activity(self) -> float:
+        return monotonic() if self._busy else self.last_read
 
     async def run(self):
         """
@@ -83,12 +123,16 @@ class CMDSockClient:
         """
         while True:
             try:
-                data = await asyncio.wait_for(self.reader.read(1024), 30)
+                data = await self.reader.read(1024)
+                self._busy = True
                 try:
                     command_res = await self._command_body(data)
                 except Exception as e:
                     log.debug(f'Client data error: {e}. Will disconnect this one...')
                     break
+                finally:
+                    self._busy = False
+                    self.last_read = monotonic()
                 if command_res:
                     self.writer.write(command_res)
                     #self.writer.write(data)
@@ -96,12 +140,6 @@ class CMDSockClient:
 
                 if data == b'':
                     break
-            except asyncio.TimeoutError:
-                self.writer.write(b'')
-                await self.writer.drain()
-                self.writer.close()
-                self._deref()
-                return
             except ConnectionResetError:
                 self.writer.close()
                 self._deref()
@@ -132,6 +170,9 @@ class CMDSockClient:
                 for_socket += f'{cl[0]} | {cl[1]} | {cl[2]}\n'
             return for_socket.encode()
 
+        elif body == 'metrics':
+            return (await self.server.proxy_metrics()).encode()
+
         elif 'read' in body.lower():
             """ Command for read a holding register from the inverter """
             try:
@@ -186,3 +227,112 @@ class CMDSockClient:
             except Exception as e:
                 return b''
 
+
+
+class GrottCMDRouter(GrottCMDSocket):
+    """
+    Command socket of the worker supervisor (multi-process mode).
+
+    The commands are passed to the command sockets of the workers. ``list``
+    is collected from all workers, ``read``/``set`` are routed to the worker
+    which serves the datalogger.
+    """
+
+    def __init__(self, ports: List[int], port: int = CMD_PORT, timeout: float = 30):
+        """
+        :param ports: Command socket ports of the workers
+        :param port: Port of the router
+        :param timeout: How long to wait for a worker response (seconds)
+        """
+        super().__init__(None, port=port)
+        self.ports = ports
+        self.timeout = timeout
+        self.routes: Dict[str, int] = {}
+        """ Datalogger serial -> command port of the worker """
+
+    def _new_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> 'CMDSockClient':
+        return CMDRouterClient(reader, writer, self)
+
+    async def query(self, port: int, command: bytes) -> bytes:
+        """
+        Send a single command to a worker
+
+        :param port: Command socket port of the worker
+        :param command: Command as received from the client
+        :return: The worker response
+        """
+        reader, writer = await asyncio.open_connection(CMD_HOST, port)
+        try:
+            writer.write(command)
+            await writer.drain()
+            writer.write_eof()
+            return await asyncio.wait_for(reader.read(), self.timeout)
+        finally:
+            writer.close()
+
+    async def list_all(self) -> bytes:
+        """ ``list`` from all workers. Refreshes the routes """
+        results = await asyncio.gather(*[self.query(port, b'list') for port in self.ports],
+                                       return_exceptions=True)
+        routes = {}
+        response = b''
+        for port, result in zip(self.ports, results):
+            if isinstance(result, Exception):
+                log.debug(f'Worker command socket {port} error: {result}')
+                continue
+            response += result
+            for line in result.decode().splitlines():
+                serial = line.split(' | ')[0]
+                if serial:
+                    routes[serial] = port
+        self.routes = routes
+        return response
+
+    async def metrics_all(self) -> str:
+        """ ``metrics`` from all workers with a worker label """
+        results = await asyncio.gather(*[self.query(port, b'metrics') for port in self.ports],
+                                       return_exceptions=True)
+        texts = []
+        for idx, (port, result) in enumerate(zip(self.ports, results)):
+            if isinstance(result, Exception):
+                log.debug(f'Worker command socket {port} error: {result}')
+                continue
+            texts.append((str(idx), result.decode()))
+        return merge_expositions(texts)
+
+    async def route(self, logger_sn: str) -> Optional[int]:
+        """ Command port of the worker serving this datalogger """
+        if logger_sn not in self.routes:
+            await self.list_all()
+        return self.routes.get(logger_sn)
+
+
+class CMDRouterClient(CMDSockClient):
+
+    async def _command_body(self, body: bytes) -> Optional[bytes]:
+        body = body.decode().lstrip().rstrip()
+        if body == 'list':
+            return await self.server.list_all()
+
+        elif body == 'metrics':
+            return (await self.server.metrics_all()).encode()
+
+        elif 'read' in body.lower() or 'set' in body.lower():
+            try:
+                logger = body.split(' ')[1]
+            except IndexError:
+                return b''
+            for _ in range(2):
+                port = await self.server.route(logger)
+                if port is None:
+                    return b''
+                try:
+                    response = await self.server.query(port, body.encode())
+                except Exception as e:
+                    log.debug(f'Worker command socket {port} error: {e}')
+                    return b''
+                if response:
+                    return response
+                """ The datalogger has probably reconnected to another worker """
+                self.server.routes.pop(logger, None)
+            return b''
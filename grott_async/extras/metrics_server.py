@@ -0,0 +1,62 @@
+"""
+Grott - HTTP endpoint for the metrics (Prometheus scrape target)
+"""
+
+import asyncio
+from logging import getLogger
+from typing import Awaitable, Callable
+from grott_async.utils.metrics import CONTENT_TYPE
+
+log = getLogger('grott')
+
+
+class GrottMetricsServer:
+    """
+    Minimal HTTP/1.0 server. GET /metrics (or /) returns the exposition text.
+
+    Examples:
+    >>> server = GrottMetricsServer(render, '127.0.0.1', 9279)
+    >>> loop.create_task(server.start())
+    """
+
+    request_timeout = 5
+    """ Seconds to wait for the request headers """
+
+    def __init__(self, render: Callable[[], Awaitable[str]], host: str, port: int):
+        """
+        :param render: Returns the exposition text
+        :param host: Listen address
+        :param port: Listen port
+        """
+        self.render = render
+        self.host = host
+        self.port = port
+        self.scrapes = 0
+
+    async def start(self):
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        log.info(f'Metrics endpoint listening on http://{self.host}:{self.port}/metrics')
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.request_timeout)
+            method, path = (request.split(b' ') + [b''])[:2]
+            if method != b'GET' or path.split(b'?')[0] not in (b'/', b'/metrics'):
+                writer.write(b'HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            else:
+                body = (await self.render()).encode()
+                self.scrapes += 1
+                writer.write(f'HTTP/1.0 200 OK\r\nContent-Type: {CONTENT_TYPE}\r\n'
+                             f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        except Exception as e:
+            log.error(f'[Metrics] Request failed: {e}')
+        finally:
+            writer.close()
@@ -1,45 +1,142 @@
+import asyncio
 try:
     import orjson as json
 except ImportError:
     import json
 import asyncio_mqtt as aiomqtt
 from logging import getLogger, Logger
-from grott_async.utils import GrottProxyConfig
+from time import perf_counter
+from typing import List
+from grott_async.utils import GrottProxyConfig, GrottRecord
+from grott_async.utils.stats import GrottHistogram
 
 
-async def _mqtt_with_auth(data: dict, conf: GrottProxyConfig):
-    async with aiomqtt.Client(conf.mqtt_server, port=conf.mqtt_port,
-                              username=conf.mqtt_user, password=conf.mqtt_pass) as client:
-        await client.publish(conf.mqtt_topic, payload=json.dumps(data))
-
+class GrottMQTTPublisher:
+    """
+    Long-lived MQTT publisher owned by the proxy server.
 
-async def _mqtt_without_auth(data: dict, conf: GrottProxyConfig):
-    async with aiomqtt.Client(conf.mqtt_server, port=conf.mqtt_port) as client:
-        await client.publish(conf.mqtt_topic, payload=json.dumps(data))
+    Records are put in a bounded queue and published over one or more persistent
+    connections to the broker. Each connection takes up to <batch_size> records
+    from the queue at once. Lost connections are re-established with a backoff
+    and the records of the interrupted batch are published after the reconnect.
 
+    Overflow policies (queue full):
+        - drop_old - discard the oldest record in the queue (default)
+        - drop_new - discard the record being published
 
-async def send_to_mqtt(data: dict, conf: GrottProxyConfig, log: Logger = None):
-    """
-    Send extracted data to MQTT broker.
-    :param data: Data extracted from LIVE_DATA packet
-    :type data: dict
-    :param conf: GrottProxy config
-    :type conf:
-    :param log: Logger used in this function
-    :type log: logging.Logger
-    :return:
-    :rtype:
+    Examples:
+    >>> publisher = GrottMQTTPublisher(config)
+    >>> publisher.start()
+    >>> publisher.publish(extracted)
     """
-    try:
-        if conf.mqtt_auth:
-            await _mqtt_with_auth(data, conf)
-        else:
-            await _mqtt_without_auth(data, conf)
-        if log:
-            log.info('[GrottProxy-MQTT sender] Data published')
-    except Exception as e:
-        if log:
-            log.exception(f'[GrottProxy-MQTT sender] Error while sending to MQTT: {e}')
 
+    OVERFLOW_DROP_OLD = 'drop_old'
+    OVERFLOW_DROP_NEW = 'drop_new'
+    _max_backoff = 60
+
+    def __init__(self, conf: GrottProxyConfig, log: Logger = None):
+        self.conf = conf
+        self.log = log or getLogger('grott')
+        self.queue: asyncio.Queue = None  # noqa
+        self.published = 0
+        self.dropped = 0
+        self.failed = 0
+        self.reconnects = 0
+        self.latency = GrottHistogram()
+        """ Publish time per batch """
+        self._workers: List[asyncio.Task] = []
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize() if self.queue else 0
+
+    @property
+    def batches(self) -> int:
+        return self.latency.count
+
+    def start(self):
+        """ Start the connections. Must be called from the running loop """
+        self.queue = asyncio.Queue(maxsize=self.conf.mqtt_queue_size)
+        loop = asyncio.get_running_loop()
+        for idx in range(max(1, self.conf.mqtt_connections)):
+            self._workers.append(loop.create_task(self._worker(idx)))
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    def publish(self, data: dict) -> bool:
+        """
+        Queue a record for publishing. Never blocks.
+
+        :param data: Data extracted from LIVE_DATA packet
+        :return: False if the record has been dropped
+        """
+        try:
+            self.queue.put_nowait(data)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.conf.mqtt_overflow == self.OVERFLOW_DROP_NEW:
+                return False
+        self.queue.get_nowait()
+        self.queue.put_nowait(data)
+        return True
+
+    def _client(self) -> aiomqtt.Client:
+        if self.conf.mqtt_auth:
+            return aiomqtt.Client(self.conf.mqtt_server, port=self.conf.mqtt_port,
+                                  username=self.conf.mqtt_user, password=self.conf.mqtt_pass)
+        return aiomqtt.Client(self.conf.mqtt_server, port=self.conf.mqtt_port)
+
+    async def _next_batch(self) -> list:
+        batch = [await self.queue.get()]
+        while len(batch) < self.conf.mqtt_batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
 
+    async def _worker(self, idx: int):
+        backoff = 1
+        batch = []
+        """ Records taken from the queue but not published yet """
+        while True:
+            try:
+                async with self._client() as client:
+                    self.log.info(f'[GrottProxy-MQTT publisher] Connection #{idx} established')
+                    backoff = 1
+                    while True:
+                        if not batch:
+                            batch = await self._next_batch()
+                        _start = perf_counter()
+                        while batch:
+                            try:
+                                record = batch[0]
+                                payload = record.json() if isinstance(record, GrottRecord) else json.dumps(record)
+                            except TypeError as e:
+                                self.log.error(f'[GrottProxy-MQTT publisher] Record dropped: {e}')
+                                self.failed += 1
+                                batch.pop(0)
+                                continue
+                            await client.publish(self.conf.mqtt_topic, payload=payload)
+                            batch.pop(0)
+                            self.published += 1
+                        elapsed = perf_counter() - _start
+                        self.latency.observe(elapsed)
+                        self.log.debug(f'[GrottProxy-MQTT publisher] Batch published [{round(elapsed * 1000, 3)}ms]')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.reconnects += 1
+                self.log.error(f'[GrottProxy-MQTT publisher] Connection #{idx} lost: {e}. Retry in {backoff}s')
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self._max_backoff)
 
+    def __str__(self):
+        return f'MQTT queue: {self.queue_depth}/{self.conf.mqtt_queue_size} | published: {self.published} | ' \
+               f'dropped: {self.dropped} | failed: {self.failed} | reconnects: {self.reconnects} | ' \
+               f'batch latency {self.latency}'
@@ -1,9 +1,15 @@
 import logging
 import abc
+from typing import List, Tuple
 
 
 class GrottProxyAsyncPlugin(abc.ABC):
 
+    batch_size = 100
+    """ Records per data_batch call """
+    batch_window = 1000
+    """ Max time (ms) a record waits for the rest of its batch """
+
     @abc.abstractmethod
     async def data(self, packet: bytes, parsed_data: dict, log: logging.Logger):
         """
@@ -11,8 +17,21 @@ class GrottProxyAsyncPlugin(abc.ABC):
 
         :param packet: Raw decoded packet as received by the proxy
         :type packet: bytes
-        :param parsed_data: Parsed data from a packet
-        :type parsed_data: dict
+        :param parsed_data: Parsed data from a packet. parsed_data.json() gives the
+            compact JSON bytes shared with the other sinks
+        :type parsed_data: GrottRecord (dict)
+        :param log: Logger
+        """
+        raise NotImplementedError
+
+    async def data_batch(self, records: List[Tuple[bytes, dict]], log: logging.Logger):
+        """
+        Optional batch entrypoint. If implemented, it is called with up to <batch_size>
+        records (or with the records collected for <batch_window> ms) instead
+        of calling data() for every packet
+
+        :param records: (packet, parsed_data) for every packet in the batch
+        :type records: List[Tuple[bytes, dict]]
         :param log: Logger
         """
         raise NotImplementedError
@@ -20,6 +39,11 @@ class GrottProxyAsyncPlugin(abc.ABC):
 
 class GrottProxySyncPlugin(abc.ABC):
 
+    batch_size = 100
+    """ Records per data_batch call """
+    batch_window = 1000
+    """ Max time (ms) a record waits for the rest of its batch """
+
     @abc.abstractmethod
     def data(self, packet: bytes, parsed_data: dict, log: logging.Logger):
         """
@@ -27,8 +51,21 @@ class GrottProxySyncPlugin(abc.ABC):
 
         :param packet: Raw decoded packet as received by the proxy
         :type packet: bytes
-        :param parsed_data: Parsed data from a packet
-        :type parsed_data: dict
+        :param parsed_data: Parsed data from a packet. parsed_data.json() gives the
+            compact JSON bytes shared with the other sinks
+        :type parsed_data: GrottRecord (dict)
+        :param log: Logger
+        """
+        raise NotImplementedError
+
+    def data_batch(self, records: List[Tuple[bytes, dict]], log: logging.Logger):
+        """
+        Optional batch entrypoint. If implemented, it is called with up to <batch_size>
+        records (or with the records collected for <batch_window> ms) instead
+        of calling data() for every packet
+
+        :param records: (packet, parsed_data) for every packet in the batch
+        :type records: List[Tuple[bytes, dict]]
         :param log: Logger
         """
         raise NotImplementedError
@@ -6,35 +6,72 @@ import asyncio
 import logging
 import signal
 import os
-try:
-    import orjson as json
-except ImportError:
-    import json
-from time import perf_counter
+from collections import defaultdict
+from itertools import count
+from time import perf_counter, monotonic
 from asyncio.streams import StreamReader, StreamWriter
 from asyncio.base_events import Server
 from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Event
-from typing import Dict
+from typing import Dict, List, Optional, Union
 from .utils.logger import GrottLogger
-from .utils import (GrottProxyConfig, GrottDataExtractor, GrottPacketType, GrottRawPacket, RegType,
+from .utils import (GrottProxyConfig, GrottBinaryDataExtractor, GrottPacketType, GrottRawPacket,
+                    FORWARD_ONLY_TYPES, DATA_TYPES, KEEP_ALIVE_TYPE, packet_type_of, GrottFrameBuffer,
+                    GrottFrameProtocol, GrottIdleReaper, GrottSpool, GrottUpstreamConnector, GrottClientRegistry,
+                    GrottTracer, GrottMetrics, GrottExposition, GrottLoopMonitor,
+                    GrottDecodePlanCache, GrottPacketLayout, GrottRecord,
                     map_03_125, map_03_45, map_04_45, map_04_125)
-from .extras.mqtt import send_to_mqtt
-from .extras.command_socket import GrottCMDSocket
+from .utils.packet_builder import data_ack
+from .extras.mqtt import GrottMQTTPublisher
+from .extras.command_socket import GrottCMDSocket, worker_cmd_port
+from .extras.metrics_server import GrottMetricsServer
 
 log = logging.getLogger('grott')
 
+_client_ids = count(1)
+""" Unique ProxyClient ids. The peer address is not unique behind a NAT """
+
 
 class AsyncProxyServer:
 
-    def __init__(self, proxy_config: GrottProxyConfig):
+    def __init__(self, proxy_config: GrottProxyConfig, worker_id: Optional[int] = None):
+        """
+        :param proxy_config: Proxy configuration
+        :param worker_id: Index of the worker process in multi-process mode (see workers.py).
+                          The listen port is shared (SO_REUSEPORT) and the command socket
+                          uses a port of its own
+        """
         self.server: Server = None  # noqa
         self.config = proxy_config
-        self.tasks = {}
-        self.clients: Dict[tuple, ProxyClient] = {}
+        self.worker_id = worker_id
+        self.tasks: Dict[int, asyncio.Task] = {}
+        """ Client id -> client task """
+        self.clients = GrottClientRegistry()
         self.host = self.config.listen_address
         self.port = self.config.listen_port
-        self.cmd_receiver = GrottCMDSocket(self)
+        self.reaper = GrottIdleReaper()
+        """ Idle timeouts of all clients and of the command socket connections """
+        if worker_id is None:
+            self.cmd_receiver = GrottCMDSocket(self, reaper=self.reaper)
+        else:
+            self.cmd_receiver = GrottCMDSocket(self, port=worker_cmd_port(worker_id), reaper=self.reaper)
+        self.decode_plans = GrottDecodePlanCache()
+        """ Shared by all clients. Dataloggers with the same layout use the same plan """
+        self.mqtt: GrottMQTTPublisher = GrottMQTTPublisher(self.config) if self.config.has_mqtt else None
+        self.upstream = GrottUpstreamConnector(self.config.growatt_srv, self.config.growatt_port,
+                                               pool_size=self.config.growatt_pool_size,
+                                               pool_max_age=self.config.growatt_pool_max_age,
+                                               dns_ttl=self.config.growatt_dns_ttl,
+                                               backoff_max=self.config.growatt_backoff_max)
+        """ Connections of all clients to the Growatt server """
+        self.metrics = GrottMetrics()
+        self.metrics.collectors.append(self.collect_metrics)
+        self.monitor = GrottLoopMonitor(self.config.lag_interval,
+                                        thresholds=(self.config.lag_shed_traces / 1000,
+                                                    self.config.lag_skip_buffered / 1000,
+                                                    self.config.lag_defer_live / 1000),
+                                        recover=self.config.lag_recover, max_deferred=self.config.lag_max_deferred)
+        """ Sheds the optional work (traces, buffered data) and defers the live data when the loop lags """
 
     async def proxy_factory(self, reader: StreamReader, writer: StreamWriter):
         """
@@ -43,19 +80,33 @@ class AsyncProxyServer:
         This method is called by the server on each new connection
         """
         cl = ProxyClient(reader, writer, server=self)
-        self.clients.update({cl.peername: cl})
-        log.info(f'[GrottProxyServer] Accepted connection from {cl.peername}')
+        self.add_client(cl)
+
+    def add_client(self, cl: 'ProxyClient'):
+        """ Register and run a new client """
+        self.clients.add(cl)
+        log.info(f'[GrottProxyServer] Accepted connection from {cl.peername} [id: {cl.id}]')
         loop = asyncio.get_running_loop()
         cl_task = loop.create_task(cl.run())
-        self.tasks.update({cl.peername: cl_task})
+        self.tasks.update({cl.id: cl_task})
         log.info(f'[GrottProxyServer] Current clients: {len(self.tasks)}')
 
     def proxy_info(self, *args, **kwargs):
         log.info('--- Current clients report ---')
-        for peer_info, client in self.clients.items():
+        log.info(f'{self.decode_plans}')
+        log.info(f'{self.reaper}')
+        log.info(f'{self.upstream}')
+        log.info(f'{self.monitor}')
+        log.info(f'{self.clients}')
+        log.info(f'{GrottLogger.pipeline()}')
+        if self.mqtt:
+            log.info(f'{self.mqtt}')
+        for plugin_stats in self.config.plugins.stats():
+            log.info(plugin_stats)
+        for client in self.clients:
             log.info(f'''
     ---- Proxy client
-    {peer_info}:
+    {client.peername} [id: {client.id}]:
     {client}
     ----
     ''')
@@ -70,40 +121,138 @@ class AsyncProxyServer:
 
     async def main(self):
 
-        self.server = await asyncio.start_server(
-            self.proxy_factory, self.host, self.port
-        )
+        loop = asyncio.get_running_loop()
+        if self.config.transport == 'protocol':
+            self.server = await loop.create_server(
+                lambda: GrottClientProtocol(self), self.host, self.port, reuse_port=self.worker_id is not None
+            )
+        else:
+            self.server = await asyncio.start_server(
+                self.proxy_factory, self.host, self.port, reuse_port=self.worker_id is not None
+            )
         addr = self.server.sockets[0].getsockname()
         log.info(f'Grott async proxy - PID [{os.getpid()}] ')
+        log.info(f'Grott async proxy - event loop: {loop.__class__.__module__}.{loop.__class__.__name__}')
+        log.info(f'Grott async proxy - transport: {self.config.transport}')
+        if self.worker_id is not None:
+            log.info(f'Grott async proxy - worker {self.worker_id}')
         log.info(f'Grott async proxy - listening on {addr}')
-        loop = asyncio.get_running_loop()
         loop.add_signal_handler(signal.SIGUSR1, self.proxy_info)
         loop.add_signal_handler(signal.SIGINT, self.stop_server)
         loop.set_exception_handler(self._server_exception)
+        reaper_task = loop.create_task(self.reaper.run())
+        upstream_task = loop.create_task(self.upstream.run())
+        monitor_task = loop.create_task(self.monitor.run())
         loop.create_task(self.cmd_receiver.start())
+        if self.config.metrics_port and self.worker_id is None:
+            """ The workers are scraped through the supervisor (see workers.py) """
+            metrics_server = GrottMetricsServer(self.render_metrics, self.config.metrics_address,
+                                                self.config.metrics_port)
+            loop.create_task(metrics_server.start())
+        if self.mqtt:
+            self.mqtt.start()
         async with self.server:
             try:
                 await self.server.serve_forever()
             except asyncio.CancelledError:
                 pass
-
-    async def client_done_cb(self, sock_name):
-        log.info(f'[GrottProxyServer] Clearing {sock_name}')
-        self.tasks.pop(sock_name)
-        self.clients.pop(sock_name)
-        log.debug(f'[GrottProxyServer] Cleared {sock_name}')
+        reaper_task.cancel()
+        upstream_task.cancel()
+        monitor_task.cancel()
+        if self.mqtt:
+            await self.mqtt.stop()
+        await self.monitor.flush()
+        await self.config.plugins.flush()
+        await self.config.plugins.drain()
+        self.config.plugins.shutdown()
+
+    async def client_done_cb(self, client: 'ProxyClient'):
+        log.info(f'[GrottProxyServer] Clearing {client.peername} [id: {client.id}]')
+        self.tasks.pop(client.id, None)
+        self.clients.remove(client)
+        if not client.logger_serial:
+            self.metrics.adopt(client.metrics, '')
+        log.debug(f'[GrottProxyServer] Cleared {client.peername} [id: {client.id}]')
         log.debug(f'[GrottProxyServer] Remaining clients: {len(self.tasks)}')
 
+    def client_identified(self, client: 'ProxyClient'):
+        """ The serials of a client are known. An older connection of the same datalogger is closed """
+        stale = self.clients.identified(client)
+        if stale is not None:
+            log.warning(f'[GrottProxyServer] Datalogger {client.logger_serial} reconnected from {client.peername}. '
+                        f'Closing the old connection {stale.peername} [id: {stale.id}]')
+            stale.writer.close()
+
     def list_clients(self):
-        clients = []
-        for cl in self.clients.values():
-            clients.append((cl.logger_serial, cl.inverter_serial, cl.proto_version))
-        return clients
+        return self.clients.listing()
+
+    async def render_metrics(self) -> str:
+        return self.metrics.render()
+
+    def collect_metrics(self, exp: GrottExposition):
+        """ Gauges and the metrics of the shared components """
+        exp.family('grott_clients', 'gauge', 'Connected dataloggers')
+        exp.sample('grott_clients', len(self.clients))
+        queued = defaultdict(int)
+        """ Serial -> queue depth. Several connections can have the same label (unknown, reconnects) """
+        for cl in self.clients:
+            queued[cl.metrics.serial] += cl.process_queue.qsize()
+        exp.family('grott_process_queue_depth', 'gauge', 'Packets waiting to be processed')
+        for serial, depth in queued.items():
+            exp.sample('grott_process_queue_depth', depth, logger=serial)
+
+        monitor = self.monitor
+        exp.family('grott_loop_lag_seconds', 'histogram', 'Delay of the scheduled loop monitor wakeups')
+        exp.histogram('grott_loop_lag_seconds', monitor.lag)
+        exp.family('grott_shed_level', 'gauge', 'Load shedding level (0 - none, 3 - live data deferred)')
+        exp.sample('grott_shed_level', monitor.level)
+        exp.family('grott_shed_events_total', 'counter', 'Load shedding levels entered')
+        for level, name in enumerate(monitor.LEVELS[1:], 1):
+            exp.sample('grott_shed_events_total', monitor.events[level], level=name)
+        exp.family('grott_shed_total', 'counter', 'Optional work shed while the loop was lagging')
+        exp.sample('grott_shed_total', monitor.traces_shed, work='traces')
+        exp.sample('grott_shed_total', monitor.buffered_skipped, work='buffered')
+        exp.sample('grott_shed_total', monitor.live_deferred, work='live_deferred')
+        exp.sample('grott_shed_total', monitor.deferred_dropped, work='live_dropped')
+        exp.family('grott_deferred_live_packets', 'gauge', 'Deferred live data packets waiting')
+        exp.sample('grott_deferred_live_packets', len(monitor.deferred))
+
+        exp.family('grott_upstream_connect_seconds', 'histogram', 'Connect time to the Growatt server')
+        exp.histogram('grott_upstream_connect_seconds', self.upstream.connect_time)
+        exp.family('grott_upstream_failures_total', 'counter', 'Failed connects to the Growatt server')
+        exp.sample('grott_upstream_failures_total', self.upstream.failures)
+
+        if self.mqtt:
+            exp.family('grott_mqtt_queue_depth', 'gauge', 'Records waiting to be published')
+            exp.sample('grott_mqtt_queue_depth', self.mqtt.queue_depth)
+            exp.family('grott_mqtt_published_total', 'counter', 'Records published')
+            exp.sample('grott_mqtt_published_total', self.mqtt.published)
+            exp.family('grott_mqtt_dropped_total', 'counter', 'Records dropped (queue full)')
+            exp.sample('grott_mqtt_dropped_total', self.mqtt.dropped)
+            exp.family('grott_mqtt_batch_seconds', 'histogram', 'Publish time of a batch')
+            exp.histogram('grott_mqtt_batch_seconds', self.mqtt.latency)
+
+        plugins = self.config.plugins
+        exp.family('grott_plugin_queue_depth', 'gauge', 'Plugin calls waiting or running')
+        for runner in list(plugins.sync_executors.values()) + list(plugins.async_runners.values()):
+            exp.sample('grott_plugin_queue_depth', runner.pending, plugin=runner.name)
+        exp.family('grott_plugin_dropped_total', 'counter', 'Plugin calls dropped (queue full)')
+        for runner in list(plugins.sync_executors.values()) + list(plugins.async_runners.values()):
+            exp.sample('grott_plugin_dropped_total', runner.dropped, plugin=runner.name)
+        exp.family('grott_plugin_seconds', 'histogram', 'Plugin call time')
+        for executor in plugins.sync_executors.values():
+            exp.histogram('grott_plugin_seconds', executor.exec_time, plugin=executor.name)
+        for runner in plugins.async_runners.values():
+            exp.histogram('grott_plugin_seconds', runner.latency, plugin=runner.name)
+
+        pipeline = GrottLogger.pipeline()
+        exp.family('grott_log_queue_depth', 'gauge', 'Log records waiting to be written')
+        exp.sample('grott_log_queue_depth', pipeline.queue.qsize())
+        exp.family('grott_log_dropped_total', 'counter', 'Log records dropped (queue full)')
+        exp.sample('grott_log_dropped_total', pipeline.dropped)
 
     def get_client(self, logger_id: str):
-        cl = [x for x in self.clients.values() if x.logger_serial == logger_id]
-        if len(cl) == 1:
-            return cl[0]
+        return self.clients.by_logger(logger_id)
 
 
 class ProxyClient:
@@ -119,27 +268,65 @@ class ProxyClient:
     __remote_port = 12000
     __max_datalen = 2 ** 16
     """ 64K bytes of data. Should be enough """
+    _stable_frames = True
+    """ The frames are slices of immutable bytes and can be queued without a copy """
 
     def __init__(self, cl_reader: StreamReader, cl_writer: StreamWriter, server: AsyncProxyServer = None):
         self.reader = cl_reader
         self.writer = cl_writer
         self.config: GrottProxyConfig = server.config
         self.server: AsyncProxyServer = server
+        self.id = next(_client_ids)
         self.peername = self.writer.get_extra_info('peername')
         self.srv_peername = ('', 0)
         self.forwarder_w: StreamWriter = None  # noqa
         self.forwarder_r: StreamReader = None  # noqa
         self.cl_read_task: asyncio.Task = None  # noqa
         self.fw_read_task: asyncio.Task = None  # noqa
+        self.process_task: asyncio.Task = None  # noqa
+        self.reconnect_task: asyncio.Task = None  # noqa
+        self.replay_task: asyncio.Task = None  # noqa
         self.msg_count = 0
         self.fwd_count = 0
+        self.proc_dropped = 0
+        self.last_read = monotonic()
+        """ Last data from the datalogger """
+        self.last_srv_read = monotonic()
+        """ Last data from the server """
+        self._closed = False
+        self._online = False
+        """ Connected to the server """
+        self._replaying = False
+        """ The spooled frames are sent before the new ones """
+        self._acks_pending = 0
+        """ Server acks of replayed packets. The datalogger got a local ack already """
+        self.spool: GrottSpool = None  # noqa
+        """ Frames for the server while it is not reachable (store-and-forward) """
+        self._spool_name = ''
+        self.local_acks = 0
+        self.spool_lost = 0
+        self.cl_fast_path: Dict[int, int] = dict.fromkeys(FORWARD_ONLY_TYPES, 0)
+        """ Packet type -> forwarded without processing (datalogger -> server) """
+        self.srv_fast_path: Dict[int, int] = dict.fromkeys(FORWARD_ONLY_TYPES, 0)
+        """ Packet type -> forwarded without processing (server -> datalogger) """
         self.device_code = None
         self.logger_serial = ''
         self.inverter_serial = ''
         self.proto_version = 0
         self.log = log
+        self.tracer = GrottTracer(self.log, self.config.trace_sample, self.server.monitor)
+        self.metrics = server.metrics.client()
+        """ Metrics of the datalogger (see GrottMetrics.adopt) """
         self._waiting_local = Event()
+        self.cl_framer = GrottFrameBuffer()
+        """ Datalogger -> Growatt stream """
+        self.srv_framer = GrottFrameBuffer()
+        """ Growatt -> Datalogger stream """
         self.local_cmd_queue = asyncio.Queue(maxsize=1)
+        self.process_queue = asyncio.Queue(maxsize=self.config.process_queue)
+        """ Packets already forwarded and waiting to be processed """
+        self._layouts: Dict[int, GrottPacketLayout] = {}
+        """ Packet type -> section layout detected for this datalogger """
 
     def _exc_handler(self, loop, context):
         self.log.exception(f'Client error... {loop} -> {context}')
@@ -153,52 +340,63 @@ class ProxyClient:
 
         loop = asyncio.get_running_loop()
         try:
-            self.forwarder_r, self.forwarder_w = await asyncio.open_connection(self.config.growatt_srv,
-                                                                               self.config.growatt_port)
-        except (ConnectionRefusedError, TimeoutError):
-            self.log.error(f'Cannot connect to {self.__remote_host}. Forwarding refused for {self.peername}')
-            """ Do not schedule anything. Cleanup this client from the server """
-            await self.server.client_done_cb(self.peername)
-            return
-        self.srv_peername = self.forwarder_w.get_extra_info('peername')
+            await self._open_upstream()
+        except OSError:
+            if not self.config.has_spool:
+                self.log.error(f'Cannot connect to {self.__remote_host}. Forwarding refused for {self.peername}')
+                """ Do not schedule anything. Close the datalogger connection and cleanup this client """
+                self._closed = True
+                self.writer.close()
+                try:
+                    await self.writer.wait_closed()
+                except (ConnectionError, OSError):
+                    pass
+                await self.server.client_done_cb(self)
+                return
+            self.log.error(f'Cannot connect to {self.config.growatt_srv}. Storing the data of {self.peername}')
+            self._go_offline()
 
+        self.process_task = loop.create_task(self.process_worker())
         self.cl_read_task = loop.create_task(self.client_read())
-        self.fw_read_task = loop.create_task(self.server_read())
+        self._watch_idle()
+
+    async def _open_upstream(self):
+        """ Connect to the server and start reading from it """
+        sock = await self.server.upstream.connect()
+        self.forwarder_r, self.forwarder_w = await asyncio.open_connection(sock=sock)
+        self.srv_peername = self.forwarder_w.get_extra_info('peername')
+        self.last_srv_read = monotonic()
+        self._online = True
+        self.fw_read_task = asyncio.get_running_loop().create_task(self.server_read())
+
+    async def _upstream_drain(self):
+        """ Wait for the server side (or the datalogger side while the local acks are sent) """
+        if not self._online:
+            await self.writer.drain()
+            return
+        try:
+            await self.forwarder_w.drain()
+        except ConnectionResetError:
+            if not self.config.has_spool:
+                raise
+            """ server_read() switches to spooling """
 
     async def client_read(self):
         while True:
             try:
-                data = await asyncio.wait_for(self.reader.read(self.__max_datalen), timeout=10*60)
-            except asyncio.TimeoutError:
-                self.log.error('[Client] read timeout. No data for 10 minutes')
-                await self.cleanup(client=True)
-                return
+                data = await self.reader.read(self.__max_datalen)
             except ConnectionResetError:
                 self.log.error('[Client] connection reset...')
                 await self.cleanup(client=True)
                 return
+            self.last_read = monotonic()
             if data == b'':
                 break
-            try:
-                packet_raw = GrottRawPacket(data)
-                await self.process_client_data(packet_raw)
-            except Exception as e:
-                self.log.exception(f'Client data error. Closing due to: {e} ')
-                self.log.debug(f'Data causing the error: {data}')
-                await self.cleanup(client=True)
-                return
-            if self._waiting_local.is_set() and packet_raw.packet_type in [GrottPacketType.REGISTER_READ,
-                                                                           GrottPacketType.REGISTER_SET]:
-                self.log.debug('Response of a locally generated command. Forwarding refused.')
-                self._waiting_local.clear()
-                try:
-                    self.local_cmd_queue.put_nowait(data)
-                except:
-                    pass
-                continue
-            self.msg_count += 1
-            self.forwarder_w.write(data)
-            await self.forwarder_w.drain()
+            _start = perf_counter()
+            for frame in self.cl_framer.feed(data):
+                self._client_frame(frame)
+            await self._upstream_drain()
+            self.metrics.forward_time.observe(perf_counter() - _start)
 
         self.log.info('Connection closed by the client...')
         await self.cleanup(client=True)
@@ -209,27 +407,226 @@ class ProxyClient:
                 data = await self.forwarder_r.read(self.__max_datalen)
             except ConnectionResetError:
                 self.log.error('[Server] connection reset...')
-                await self.cleanup(server=True)
+                await self._upstream_lost()
                 return
-            self.log.debug(data)
+            self.last_srv_read = monotonic()
             if data == b'':
                 break
-            try:
-                await self.process_server_data(data)
-            except Exception as e:
-                self.log.exception(f'Server data error. Closing the connections due to: {e} ')
-                self.log.debug(f'Data causing the error: {data}')
-                await self.cleanup(server=True)
-                return
-            """ This probably the section below needs to be moved in process_server_data 
-                if the inbound command must be blocked
-            """
-            self.fwd_count += 1
-            self.writer.write(data)
+            for frame in self.srv_framer.feed(data):
+                self._server_frame(frame)
             await self.writer.drain()
         self.log.info('Connection closed by the remote server....')
+        await self._upstream_lost()
+
+    async def _upstream_lost(self):
+        """ Keep the datalogger connected (store-and-forward) or close both sides """
+        if self.config.has_spool and not self._closed:
+            self.forwarder_w.close()
+            self._go_offline()
+            return
         await self.cleanup(server=True)
 
+    def _go_offline(self):
+        """ Spool the frames for the server and try to reconnect """
+        self._online = False
+        self._replaying = False
+        self._acks_pending = 0
+        self.server.reaper.forget((self.id, 'server'))
+        if self.replay_task:
+            self.replay_task.cancel()
+        self.log.warning(f'Server not reachable. Spooling to {self.config.spool_dir}. '
+                         f'Reconnecting (max delay {self.config.spool_retry}s)')
+        self.reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        attempt = 0
+        while not self._closed:
+            attempt += 1
+            await asyncio.sleep(self.server.upstream.retry_delay(attempt, cap=self.config.spool_retry))
+            try:
+                await self._open_upstream()
+            except OSError as e:
+                self.log.debug(f'Reconnect failed: {e}')
+                continue
+            self.log.info(f'Server connection restored {self.srv_peername}')
+            self._watch_server_idle()
+            self._start_replay()
+            return
+
+    def _start_replay(self):
+        if self.spool is None or not self.spool.pending:
+            return
+        self._replaying = True
+        self.replay_task = asyncio.get_running_loop().create_task(self._replay())
+
+    async def _replay(self):
+        """ Send the spooled frames at spool_replay_rate. Then forward directly again """
+        interval = 1 / self.config.spool_replay_rate if self.config.spool_replay_rate > 0 else 0
+        self.log.info(f'Replaying {self.spool.pending} spooled bytes')
+        while self._online:
+            frame = self.spool.peek()
+            if frame is None:
+                self._replaying = False
+                self.log.info(f'Spool replayed. Forwarding directly. {self.spool}')
+                return
+            self.forwarder_w.write(frame)
+            if packet_type_of(frame) in DATA_TYPES:
+                self._acks_pending += 1
+            self.spool.pop(len(frame))
+            await self._upstream_drain()
+            await asyncio.sleep(interval)
+
+    def _check_spool(self, packet: GrottRawPacket) -> None:
+        """ First packet with a datalogger serial. Replay what was spooled in a previous session """
+        self._spool_name = ''.join(x for x in packet.datalogger_serial.decode(errors='ignore') if x.isalnum())
+        if self._spool_name and os.path.exists(os.path.join(self.config.spool_dir, f'{self._spool_name}.spool')):
+            self.spool = GrottSpool(self.config.spool_dir, self._spool_name, self.config.spool_max_size * 1024 ** 2)
+            if self._online:
+                self._start_replay()
+
+    def _spool_frame(self, frame: memoryview) -> bool:
+        if self.spool is None:
+            if not self._spool_name:
+                """ Datalogger not known yet """
+                self.spool_lost += 1
+                return False
+            self.spool = GrottSpool(self.config.spool_dir, self._spool_name, self.config.spool_max_size * 1024 ** 2)
+        if not self.spool.append(frame):
+            self.log.warning(f'Spool full. Frame dropped [dropped: {self.spool.dropped}]')
+            return False
+        return True
+
+    def _to_upstream(self, frame: memoryview, type_num: int) -> None:
+        """ Forward a datalogger frame or spool it while the server is not reachable """
+        self.msg_count += 1
+        if self._online and not self._replaying:
+            self.forwarder_w.write(frame)
+            return
+        if type_num == KEEP_ALIVE_TYPE:
+            if self._online:
+                self.forwarder_w.write(frame)
+            else:
+                """ The Growatt server echoes the keep-alive """
+                self.writer.write(frame)
+            return
+        if self._spool_frame(frame) and type_num in DATA_TYPES:
+            self.writer.write(data_ack(frame))
+            self.local_acks += 1
+
+    def _stop_spooling(self):
+        for task in (self.reconnect_task, self.replay_task):
+            if task:
+                task.cancel()
+        if self.spool is not None:
+            self.log.info(f'{self.spool}')
+            self.spool.close()
+
+    def _watch_idle(self):
+        """ Register the idle limits of both directions in the server reaper """
+        self.server.reaper.watch((self.id, 'client'), self.config.client_idle, lambda: self.last_read,
+                                 self._client_idle)
+        if self._online:
+            self._watch_server_idle()
+
+    def _watch_server_idle(self):
+        self.server.reaper.watch((self.id, 'server'), self.config.server_idle, lambda: self.last_srv_read,
+                                 self._server_idle)
+
+    def _forget_idle(self):
+        self.server.reaper.forget((self.id, 'client'))
+        self.server.reaper.forget((self.id, 'server'))
+
+    def _client_idle(self):
+        """ Closing the transport ends the client reading and starts the cleanup """
+        self.log.error(f'[Client] read timeout. No data for {self.config.client_idle} seconds')
+        self.writer.close()
+
+    def _server_idle(self):
+        self.log.error(f'[Server] read timeout. No data for {self.config.server_idle} seconds')
+        self.forwarder_w.close()
+
+    def _client_frame(self, frame: memoryview) -> None:
+        """
+        Forward a datalogger frame (or keep the response of a local command)
+        and queue it for processing
+        """
+        type_num = packet_type_of(frame)
+        metrics = self.metrics
+        metrics.cl_frames[type_num] += 1
+        metrics.cl_bytes += len(frame)
+        if type_num in FORWARD_ONLY_TYPES and self.logger_serial:
+            """ Control frames. Nothing to learn from them once the datalogger is known """
+            self.cl_fast_path[type_num] += 1
+            self._to_upstream(frame, type_num)
+            return
+        try:
+            packet_raw = GrottRawPacket(frame if self._stable_frames else bytes(frame))
+        except Exception as e:
+            """ Not even a header. Forward it as it is """
+            self.log.error(f'Client data error: {e}')
+            self.log.debug(f'Data causing the error: {bytes(frame)}')
+            self._to_upstream(frame, type_num)
+            return
+        if self.config.has_spool and not self._spool_name:
+            self._check_spool(packet_raw)
+        self._queue_for_processing(packet_raw)
+        if self._waiting_local.is_set() and packet_raw.packet_type in [GrottPacketType.REGISTER_READ,
+                                                                       GrottPacketType.REGISTER_SET]:
+            self.log.debug('Response of a locally generated command. Forwarding refused.')
+            self._waiting_local.clear()
+            try:
+                self.local_cmd_queue.put_nowait(packet_raw.packet)
+            except:
+                pass
+            return
+        self._to_upstream(frame, type_num)
+
+    def _server_frame(self, frame: memoryview) -> None:
+        """ Forward a server frame and queue it for processing """
+        self.fwd_count += 1
+        type_num = packet_type_of(frame)
+        metrics = self.metrics
+        metrics.srv_frames[type_num] += 1
+        metrics.srv_bytes += len(frame)
+        if self._acks_pending and type_num in DATA_TYPES and (frame[4] << 8 | frame[5]) == 3:
+            """ Ack of a replayed packet. The datalogger got a local ack when it was spooled """
+            self._acks_pending -= 1
+            return
+        """ This probably the section below needs to be moved in process_server_data 
+            if the inbound command must be blocked
+        """
+        self.writer.write(frame)
+        if type_num in FORWARD_ONLY_TYPES:
+            self.srv_fast_path[type_num] += 1
+            return
+        self._queue_for_processing(frame if self._stable_frames else bytes(frame), server=True)
+
+    def _queue_for_processing(self, packet: Union[GrottRawPacket, memoryview, bytes], server: bool = False) -> None:
+        """ Never blocks the forwarding. The packet is only logged if the queue is full """
+        try:
+            self.process_queue.put_nowait((server, packet))
+        except asyncio.QueueFull:
+            self.proc_dropped += 1
+            self.metrics.proc_dropped += 1
+            self.log.warning(f'Processing queue full. Packet forwarded without processing '
+                             f'[dropped: {self.proc_dropped}]')
+
+    async def process_worker(self):
+        """
+        Process the packets already forwarded in both directions.
+        Errors are logged and the connection stays open
+        """
+        while True:
+            server, packet = await self.process_queue.get()
+            try:
+                if server:
+                    await self.process_server_data(packet)
+                else:
+                    await self.process_client_data(packet)
+            except Exception as e:
+                self.log.exception(f'{"Server" if server else "Client"} data error: {e}')
+                self.log.debug(f'Data causing the error: {bytes(packet) if server else bytes(packet.packet)}')
+
     async def cleanup(self, server=False, client=False) -> None:
         """
         ProxyClient cleanup.
@@ -240,28 +637,37 @@ class ProxyClient:
 
         :return:
         """
+        if self._closed:
+            return
+        self._closed = True
+        self._forget_idle()
         self.log.info(f'Proxy client cleanup started [cl: {client}, srv: {server}]')
         if client:
             self.writer.close()
-            self.forwarder_w.write_eof()
-            self.forwarder_w.close()
+            if self._online:
+                self.forwarder_w.write_eof()
+                self.forwarder_w.close()
         elif server:
             self.forwarder_w.close()
             self.writer.write_eof()
             self.writer.close()
-        self.fw_read_task.cancel()
-        self.cl_read_task.cancel()
+        for task in (self.fw_read_task, self.cl_read_task, self.process_task):
+            if task:
+                task.cancel()
+        self._stop_spooling()
         self.log.info(f'All sockets closed. Client stopped.')
-        await self.server.client_done_cb(self.peername)
+        await self.server.client_done_cb(self)
 
-    async def process_server_data(self, data: bytes) -> None:
+    async def process_server_data(self, data: memoryview) -> None:
         """ To be implemented
             Async in case that the processing needs async code
         """
+        if not self.tracer.sampled(server=True):
+            return
         _start_processing = perf_counter()
         packet = GrottRawPacket(data)
-        self.log.debug(packet)
-        self.log.debug(f'*** SRV PACKET PROCESSED [{round((perf_counter() - _start_processing) * 1000, 3)}ms]***')
+        self.tracer.trace(packet)
+        self.tracer.trace('*** SRV PACKET PROCESSED [%sms]***', round((perf_counter() - _start_processing) * 1000, 3))
         return
 
     async def process_client_data(self, packet: GrottRawPacket) -> None:
@@ -269,104 +675,324 @@ class ProxyClient:
             Async in case that the processing needs async code
         """
         _start_processing = perf_counter()
-        self.log.debug(packet)
+        trace = self.tracer.sampled()
+        if trace:
+            self.tracer.trace(packet)
         if packet.valid_crc is False:
             self.log.error('CRC check failed. Packet not processed!!!')
+            self.metrics.crc_errors += 1
             return
+        identified = False
+        """ A serial has been learned from this packet """
+        logger_learned = False
         if self.logger_serial == '':
             self.logger_serial = packet.datalogger_serial.decode()
-            if self.logger_serial != '' and \
-                    self.config.separate_logs is True and \
-                    self.config.log_to == 'file':
-                self._setup_own_logger()
+            if self.logger_serial != '':
+                identified = logger_learned = True
+                if self.config.separate_logs is True and self.config.log_to == 'file':
+                    self._setup_own_logger()
         if self.inverter_serial == '':
             self.inverter_serial = packet.inverter_serial.decode()
+            if self.inverter_serial != '':
+                identified = True
         if self.proto_version == 0:
             self.proto_version = packet.protocol_version
+        if identified:
+            self.server.client_identified(self)
+        if logger_learned:
+            self.metrics = self.server.metrics.adopt(self.metrics, self.logger_serial)
         if packet.packet_type in [GrottPacketType.INVERTER_REPORT, GrottPacketType.LIVE_DATA,
                                   GrottPacketType.BUFFERED_DATA] \
                 and packet.data_length > 100:
-            parsed = GrottDataExtractor(packet.decrypted_packet().hex())
-            self.log.debug(f'{parsed.inverter.name} <reg markers>: {parsed.regmaps}')
-            self.log.debug(f'{parsed.inverter.name} <maps per section>: {parsed.registers_per_section}')
-            self.log.debug(f'{parsed.inverter.name} <detected registers>: {parsed.registers}')
-
-            if parsed.registers_per_section == 125:
-                mapping = map_03_125 if packet.packet_type == GrottPacketType.INVERTER_REPORT else map_04_125
+            monitor = self.server.monitor
+            if packet.packet_type == GrottPacketType.BUFFERED_DATA and monitor.skip_buffered:
+                """ Already forwarded. Not extracted while the loop is overloaded """
+                monitor.buffered_skipped += 1
+            elif packet.packet_type == GrottPacketType.LIVE_DATA and monitor.defer_live:
+                """ Decoded and dispatched (in order) when the loop has recovered """
+                monitor.defer(self.decode_packet, packet, False)
             else:
-                mapping = map_03_45 if packet.packet_type == GrottPacketType.INVERTER_REPORT else map_04_45
-
-            if packet.packet_type == GrottPacketType.INVERTER_REPORT:
-                """ We need data from the report packet packets
-                    in order to determine which registers must be extracted 
-                """
-                log.debug(f'{parsed.inverter}: {parsed.regmaps}')
-                for k in mapping.values():
-                    if k.id == 43:
-                        """ DTC is at the same location for all inverters """
-                        if self.device_code is None:
-                            self.device_code = parsed.int_at(k.id)
-                        self.log.debug(f'{k.description}: {parsed.int_at(k.id)}')
-                    if k.id == 34 or k.id == 125 and parsed.registers_per_section == 125:
-                        self.log.debug(f'{k.description}: {parsed.ascii_at(k.id, k.id + k.length)}')
-
-            elif packet.packet_type == GrottPacketType.LIVE_DATA and packet.data_length > 100:
-                reg_filter = self.config.dtc_mapping.get(self.device_code, mapping.keys())
-                """ Use a filter and fallback to all registers 
-                    in the complete map if this DTC is not specified in the config 
-                """
-                self.log.debug(f'Filter: {reg_filter}')
-                extracted = {'device': self.inverter_serial, 'time': parsed.tstamp, 'buffered': parsed.buffered,
-                             'values': {'logger_serial': self.logger_serial, 'pv_serial': self.inverter_serial}}
-                for k in mapping.values():
-                    if k.id not in reg_filter:
-                        continue
-                    if k.type == RegType.TEXT:
-                        value = parsed.ascii_at(k.id, k.id + k.length)
-                    elif k.length == 1:
-                        value = k.format(parsed.int_at(k.id))
-                    elif k.length == 2:
-                        value = k.format(parsed.long_at(k.id))
-                    extracted['values'].update({k.description: value})
-                if json.__name__ == 'orjson':
-                    self.log.debug(json.dumps(extracted, option=json.OPT_INDENT_2).decode())  # noqa
-                else:
-                    self.log.debug(json.dumps(extracted, indent=2))
-                loop = asyncio.get_running_loop()
-
-                if self.config.has_mqtt:
-                    task = loop.create_task(send_to_mqtt(extracted, self.config, self.log))
-
-                """ Distribute the data to all plugins """
-                for plugin in self.config.plugins.sync_plugins.values():
-                    loop.run_in_executor(None, plugin.data, packet.decrypted_packet(), extracted, self.log)
-                for plugin in self.config.plugins.async_plugins.values():
-                    loop.create_task(plugin.data(packet.decrypted_packet(), extracted, self.log))
-        self.log.debug(f'*** PACKET PROCESSED [{round((perf_counter() - _start_processing) * 1000, 3)}ms]***')
+                await self.decode_packet(packet, trace)
+        if trace:
+            self.tracer.trace('*** PACKET PROCESSED [%sms]***', round((perf_counter() - _start_processing) * 1000, 3))
         # TODO: distribute the data to other plugins specified in the config after this point
         return
 
+    async def decode_packet(self, packet: GrottRawPacket, trace: bool) -> None:
+        """ Extract the data packets, publish and dispatch the records of the live data """
+        _start_decode = perf_counter()
+        layout = self._layouts.get(packet.packet_type_num)
+        parsed = GrottBinaryDataExtractor(packet.decrypted_packet(), layout=layout)
+        if parsed.layout is not layout:
+            """ First packet of this type or the layout has changed """
+            self._layouts[packet.packet_type_num] = parsed.layout
+        if trace:
+            self.tracer.trace('%s <reg markers>: %s', parsed.inverter.name, parsed.regmaps)
+            self.tracer.trace('%s <maps per section>: %s', parsed.inverter.name, parsed.registers_per_section)
+            self.tracer.trace('%s <detected registers>: %s', parsed.inverter.name, parsed.registers)
+
+        if parsed.registers_per_section == 125:
+            mapping = map_03_125 if packet.packet_type == GrottPacketType.INVERTER_REPORT else map_04_125
+        else:
+            mapping = map_03_45 if packet.packet_type == GrottPacketType.INVERTER_REPORT else map_04_45
+
+        if packet.packet_type == GrottPacketType.INVERTER_REPORT:
+            """ We need data from the report packet packets
+                in order to determine which registers must be extracted 
+            """
+            if trace:
+                self.tracer.trace('%s: %s', parsed.inverter, parsed.regmaps)
+            for k in mapping.values():
+                if k.id == 43:
+                    """ DTC is at the same location for all inverters """
+                    if self.device_code is None:
+                        self.device_code = parsed.int_at(k.id)
+                    if trace:
+                        self.tracer.trace('%s: %s', k.description, parsed.int_at(k.id))
+                if trace and (k.id == 34 or k.id == 125 and parsed.registers_per_section == 125):
+                    self.tracer.trace('%s: %s', k.description, parsed.ascii_at(k.id, k.id + k.length))
+
+        elif packet.packet_type == GrottPacketType.LIVE_DATA:
+            reg_filter = self.config.dtc_mapping.get(self.device_code)
+            """ Use a filter and fallback to all registers (None)
+                in the complete map if this DTC is not specified in the config 
+            """
+            if trace:
+                self.tracer.trace('Filter: %s', reg_filter)
+            extracted = GrottRecord({'device': self.inverter_serial, 'time': parsed.tstamp,
+                                     'buffered': parsed.buffered,
+                                     'values': {'logger_serial': self.logger_serial,
+                                                'pv_serial': self.inverter_serial}})
+            plan = self.server.decode_plans.get(mapping, reg_filter, parsed)
+            extracted['values'].update(plan.decode(parsed.packet))
+            _start_dispatch = perf_counter()
+            self.metrics.decode_time.observe(_start_dispatch - _start_decode)
+            if trace:
+                self.tracer.trace(extracted.json().decode())
+            if self.server.mqtt:
+                self.server.mqtt.publish(extracted)
+
+            """ Distribute the data to all plugins """
+            await self.config.plugins.dispatch(packet.decrypted_packet(), extracted, self.log)
+            self.metrics.dispatch_time.observe(perf_counter() - _start_dispatch)
+
     def _setup_own_logger(self):
         """ Logging to a separate file for every datalogger """
         setup_log = GrottLogger(self.config.log_to, fname=f'grott_cl_{self.logger_serial}.log',
                                 logger_name=f'grott-{self.logger_serial}', level=self.config.log_level, keep=1)
 
         self.log = logging.getLogger(f'grott-{self.logger_serial}')
+        self.tracer = GrottTracer(self.log, self.config.trace_sample, self.server.monitor)
 
     async def send_local_command(self, command: bytes):
         self.log.debug('Sending locally generated command')
-        self.log.debug(GrottRawPacket(command))
+        if self.tracer.enabled:
+            self.tracer.trace(GrottRawPacket(command))
         self.writer.write(command)
         self._waiting_local.set()
         await self.writer.drain()
 
 
+    @staticmethod
+    def _fast_path_str(counters: Dict[int, int]) -> str:
+        return ', '.join(f'{GrottPacketType(k.to_bytes(2, "big")).name}: {v}' for k, v in sorted(counters.items()))
+
     def __repr__(self):
-        return f'<{self.__class__.__name__}({self.peername})> cl_msgs: {self.msg_count} | srv_msgs: {self.fwd_count}'
+        return f'<{self.__class__.__name__}({self.id}, {self.peername})> cl_msgs: {self.msg_count} | srv_msgs: {self.fwd_count}'
 
     def __str__(self):
-        return f'''<{self.__class__.__name__}> 
+        base = f'''<{self.__class__.__name__}> 
         DTC: {self.device_code} | InvSerial: {self.inverter_serial} | Datalogger: {self.logger_serial}
         Stats -  Client msgs: {self.msg_count} | Server msgs: {self.fwd_count}
+        Processing - queued: {self.process_queue.qsize()} | dropped: {self.proc_dropped}
+        Forward only - client: {self._fast_path_str(self.cl_fast_path)} | server: {self._fast_path_str(self.srv_fast_path)}
         '''
+        if self.config.has_spool:
+            base += f'''Store-and-forward - online: {self._online} | local acks: {self.local_acks} | lost: {self.spool_lost}
+        {self.spool if self.spool is not None else 'Spool: -'}
+        '''
+        return base
+
+
+
+class ProtocolProxyClient(ProxyClient):
+    """
+    Proxy client built on asyncio transports/protocols (transport = protocol).
+
+    The frames are cut in place in the receive buffers (see GrottFrameProtocol)
+    and written directly to the opposite transport. There are no StreamReader
+    copies and no drain() calls. Reading from one side is paused while the
+    opposite transport has too much buffered data.
+    """
+    _stable_frames = False
+
+    def __init__(self, transport: asyncio.Transport, protocol: 'GrottClientProtocol', server: AsyncProxyServer):
+        super().__init__(None, transport, server=server)  # noqa
+        self.cl_protocol = protocol
+        self.srv_protocol: GrottUpstreamProtocol = None  # noqa
+        self.loop = asyncio.get_running_loop()
+
+    async def run(self):
+        """
+        Connect to the server and start reading from the datalogger
+        """
+        try:
+            await self._open_upstream()
+        except OSError:
+            if not self.config.has_spool:
+                self.log.error(f'Cannot connect to {self.config.growatt_srv}. Forwarding refused for {self.peername}')
+                self._stop(client=True)
+                return
+        if self._closed:
+            """ The datalogger has gone in the meantime """
+            if self._online:
+                self.forwarder_w.close()
+            return
+        if not self._online:
+            self.log.error(f'Cannot connect to {self.config.growatt_srv}. Storing the data of {self.peername}')
+            self._go_offline()
+        self.process_task = self.loop.create_task(self.process_worker())
+        self._watch_idle()
+        """ The local acks are written to the datalogger while offline """
+        self.cl_protocol.start(self.forwarder_w if self._online else self.writer)
+
+    async def _open_upstream(self):
+        sock = await self.server.upstream.connect()
+        self.forwarder_w, self.srv_protocol = await self.loop.create_connection(
+            lambda: GrottUpstreamProtocol(self), sock=sock)
+        self.srv_peername = self.forwarder_w.get_extra_info('peername')
+        self.last_srv_read = monotonic()
+        self._online = True
+        self.cl_protocol.peer = self.forwarder_w
+
+    async def _upstream_drain(self):
+        """ Nothing to wait for. Reading is paused by the transports flow control """
+
+    def _go_offline(self):
+        super()._go_offline()
+        """ The frames are spooled and only the local acks are written """
+        self.cl_protocol.peer = self.writer
+
+    def connection_lost(self, client=False, server=False, exc: Optional[Exception] = None):
+        if self._closed:
+            return
+        if exc:
+            self.log.error(f'[{"Client" if client else "Server"}] connection lost: {exc}')
+        elif client:
+            self.log.info('Connection closed by the client...')
+        else:
+            self.log.info('Connection closed by the remote server....')
+        if server and self.config.has_spool:
+            self._go_offline()
+            return
+        self._stop(client=client, server=server)
+
+    def _stop(self, client=False, server=False):
+        if self._closed:
+            return
+        self._closed = True
+        self.loop.create_task(self.cleanup(client=client, server=server))
+
+    async def cleanup(self, server=False, client=False) -> None:
+        """
+        Close both transports (EOF to the opposite side) and inform the server
+        that this client has exited.
+        """
+        self._closed = True
+        self._forget_idle()
+        self.log.info(f'Proxy client cleanup started [cl: {client}, srv: {server}]')
+        opposite = (self.forwarder_w if self._online else None) if client else self.writer
+        if opposite is not None and opposite.can_write_eof():
+            opposite.write_eof()
+        for transport in (self.writer, self.forwarder_w):
+            if transport is not None:
+                transport.close()
+        if self.process_task:
+            self.process_task.cancel()
+        self._stop_spooling()
+        self.log.info(f'All sockets closed. Client stopped.')
+        await self.server.client_done_cb(self)
+
+    async def send_local_command(self, command: bytes):
+        self.log.debug('Sending locally generated command')
+        if self.tracer.enabled:
+            self.tracer.trace(GrottRawPacket(command))
+        self.writer.write(command)
+        self._waiting_local.set()
 
+
+class GrottClientProtocol(GrottFrameProtocol):
+    """ Datalogger side of a ProtocolProxyClient """
+
+    def __init__(self, server: AsyncProxyServer):
+        super().__init__()
+        self.server = server
+        self.client: ProtocolProxyClient = None  # noqa
+
+    def connection_made(self, transport: asyncio.Transport):
+        super().connection_made(transport)
+        """ Nothing is read before the server connection is ready """
+        transport.pause_reading()
+        self.client = ProtocolProxyClient(transport, self, server=self.server)
+        self.server.add_client(self.client)
+
+    def start(self, peer: asyncio.WriteTransport):
+        """ The server connection is ready. Forward what was received so far """
+        self.peer = peer
+        super().buffer_updated(0)
+        self.transport.resume_reading()
+
+    def buffer_updated(self, nbytes: int):
+        self.client.last_read = monotonic()
+        if self.peer is None:
+            """ Not all loops allow pausing in connection_made. Keep the data in the buffer """
+            self._end += nbytes
+            self.transport.pause_reading()
+            return
+        super().buffer_updated(nbytes)
+
+    def frames_received(self, frames: List[memoryview]):
+        _start = perf_counter()
+        for frame in frames:
+            self.client._client_frame(frame)
+        self.client.metrics.forward_time.observe(perf_counter() - _start)
+
+    def pause_writing(self):
+        if self.client._online:
+            self.client.forwarder_w.pause_reading()
+
+    def resume_writing(self):
+        if self.client._online:
+            self.client.forwarder_w.resume_reading()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.client.connection_lost(client=True, exc=exc)
+
+
+class GrottUpstreamProtocol(GrottFrameProtocol):
+    """ Growatt server side of a ProtocolProxyClient """
+
+    def __init__(self, client: ProtocolProxyClient):
+        super().__init__()
+        self.client = client
+        self.peer = client.writer
+
+    def buffer_updated(self, nbytes: int):
+        self.client.last_srv_read = monotonic()
+        super().buffer_updated(nbytes)
+
+    def frames_received(self, frames: List[memoryview]):
+        for frame in frames:
+            self.client._server_frame(frame)
+
+    def pause_writing(self):
+        self.client.writer.pause_reading()
+
+    def resume_writing(self):
+        self.client.writer.resume_reading()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if self.client.srv_protocol is not self:
+            """ A connection replaced after a reconnect """
+            return
+        self.client.connection_lost(server=True, exc=exc)
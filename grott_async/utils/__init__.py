@@ -1,7 +1,18 @@
 from .config import GrottProxyConfig
 from .packet import (RegType, GrottRegister, GrottPacketType, GrottRawPacket,
-                     GrottConstants)
-from .data_extractor import GrottDataExtractor, GrottDataMarker
+                     GrottConstants, FORWARD_ONLY_TYPES, DATA_TYPES, KEEP_ALIVE_TYPE, packet_type_of)
+from .framer import GrottFrameBuffer, GrottFrameProtocol
+from .data_extractor import GrottDataExtractor, GrottBinaryDataExtractor, GrottDataMarker, GrottPacketLayout
+from .record import GrottRecord
+from .decode_plan import GrottDecodePlan, GrottDecodePlanCache
 from .protocol import map_03_45, map_04_45, map_03_125, map_04_125
 from .logger import GrottLogger
+from .event_loop import setup_event_loop, EVENT_LOOPS
+from .reaper import GrottIdleReaper
+from .spool import GrottSpool
+from .upstream import GrottUpstreamConnector
+from .registry import GrottClientRegistry
+from .trace import GrottTracer, TRACE_LOGGER
+from .metrics import GrottMetrics, GrottExposition, merge_expositions
+from .loop_monitor import GrottLoopMonitor
 from ._dyn_loader import GrottPluginLoader
@@ -1,14 +1,263 @@
+import asyncio
 import inspect
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from importlib import import_module
-from logging import getLogger
-from typing import Dict
+from logging import getLogger, Logger
+from time import perf_counter
+from typing import Dict, List, Optional, Set, Tuple, Union, TYPE_CHECKING
 from grott_async.extras.plugin import GrottProxySyncPlugin, GrottProxyAsyncPlugin
+from .stats import GrottHistogram
+if TYPE_CHECKING:
+    from .config import GrottProxyConfig
 
 log = getLogger('grott')
 
 
+class GrottBatchCollector:
+    """
+    Collects records for the data_batch entrypoint of a plugin.
+
+    The batch is handed to the plugin dispatcher when it reaches <size>
+    records or <window> ms after its first record, whichever comes first.
+    """
+
+    def __init__(self, dispatcher: '_GrottPluginDispatcher', size: int = 100, window: int = 1000):
+        """
+        :param dispatcher: Executor/runner of the plugin
+        :param size: Max records per batch
+        :param window: Max time (ms) a record waits for the rest of its batch
+        """
+        self.dispatcher = dispatcher
+        self.size = max(1, size)
+        self.window = window
+        self.batches = 0
+        self._records: List[Tuple[bytes, dict]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: Set[asyncio.Task] = set()
+
+    async def add(self, packet: bytes, parsed_data: dict):
+        self._records.append((packet, parsed_data))
+        if len(self._records) >= self.size:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window / 1000, self._window_expired)
+
+    def _window_expired(self):
+        self._timer = None
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def flush(self):
+        """ Send the collected records (if any) to the plugin """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        records, self._records = self._records, []
+        if records:
+            self.batches += 1
+            await self.dispatcher.submit(records, log, batch=True)
+
+
+class _GrottPluginDispatcher:
+    """
+    Common part of the plugin executors/runners.
+
+    Calls are queued up to <queue_size>. When the queue is full the call is
+    dropped (overflow = drop) or the caller waits for a free slot (overflow = block).
+    """
+
+    OVERFLOW_DROP = 'drop'
+    OVERFLOW_BLOCK = 'block'
+
+    def __init__(self, name: str, plugin: Union[GrottProxySyncPlugin, GrottProxyAsyncPlugin], base: type,
+                 queue_size: int = 100, overflow: str = OVERFLOW_DROP):
+        self.name = name
+        self.plugin = plugin
+        self.queue_size = max(1, queue_size)
+        self.overflow = overflow
+        self.dropped = 0
+        self.errors = 0
+        self.collector: Optional[GrottBatchCollector] = None
+        """ Set if the plugin implements data_batch """
+        self._slots: Optional[asyncio.Semaphore] = None
+        """ Created on first use in the running loop """
+        if type(plugin).data_batch is not base.data_batch:
+            self.collector = GrottBatchCollector(self, plugin.batch_size, plugin.batch_window)
+
+    async def dispatch(self, packet: bytes, parsed_data: dict, log_: Logger):
+        """ Hand the data from a packet to the plugin (directly or through the batch collector) """
+        if self.collector:
+            await self.collector.add(packet, parsed_data)
+        else:
+            await self.submit(packet, parsed_data, log_)
+
+    async def submit(self, *args, batch: bool = False):
+        """ Schedule a call of plugin.data(*args) or plugin.data_batch(*args) """
+        raise NotImplementedError
+
+    async def _take_slot(self) -> bool:
+        """ Wait for (or check for) a free slot in the queue. False if the call must be dropped """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.queue_size)
+        if self._slots.locked() and self.overflow != self.OVERFLOW_BLOCK:
+            self.dropped += 1
+            return False
+        await self._slots.acquire()
+        return True
+
+    async def flush(self):
+        if self.collector:
+            await self.collector.flush()
+
+
+class GrottPluginExecutor(_GrottPluginDispatcher):
+    """
+    Dedicated worker pool for a sync plugin.
+
+    A slow plugin fills only its own queue and does not delay the other plugins.
+    """
+
+    def __init__(self, name: str, plugin: GrottProxySyncPlugin, workers: int = 1, queue_size: int = 100,
+                 overflow: str = _GrottPluginDispatcher.OVERFLOW_DROP):
+        """
+        :param name: Plugin name
+        :param plugin: The plugin
+        :param workers: Worker threads
+        :param queue_size: Max calls waiting or running
+        :param overflow: Policy when the queue is full [drop/block]
+        """
+        super(GrottPluginExecutor, self).__init__(name, plugin, GrottProxySyncPlugin, queue_size, overflow)
+        self.workers = max(1, workers)
+        self.pending = 0
+        """ Calls waiting or running in the pool """
+        self.executed = 0
+        self.exec_time = GrottHistogram()
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'grott-{name}')
+
+    async def submit(self, *args, batch: bool = False):
+        if not await self._take_slot():
+            return
+        self.pending += 1
+        func = self.plugin.data_batch if batch else self.plugin.data
+        fut = asyncio.get_running_loop().run_in_executor(self._pool, self._run, func, *args)
+        fut.add_done_callback(self._done)
+
+    @staticmethod
+    def _run(func, *args) -> Tuple[float, Optional[Exception]]:
+        """ Runs in the pool """
+        _start = perf_counter()
+        try:
+            func(*args)
+        except Exception as e:
+            return perf_counter() - _start, e
+        return perf_counter() - _start, None
+
+    def _done(self, fut: asyncio.Future):
+        """ Runs in the loop """
+        self.pending -= 1
+        self._slots.release()
+        if fut.cancelled():
+            return
+        elapsed, error = fut.result()
+        self.executed += 1
+        self.exec_time.observe(elapsed)
+        if error:
+            self.errors += 1
+            log.error(f'[Plugin {self.name}] failed: {error}')
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+    def __str__(self):
+        return f'[Plugin {self.name}] workers: {self.workers} | queue: {self.pending}/{self.queue_size} | ' \
+               f'executed: {self.executed} | dropped: {self.dropped} | errors: {self.errors} | ' \
+               f'exec time {self.exec_time}'
+
+
+class GrottAsyncPluginRunner(_GrottPluginDispatcher):
+    """
+    Supervised dispatch for an async plugin.
+
+    Every call runs in a task referenced by the runner until it completes.
+    At most <max_inflight> calls run concurrently, each one is cancelled after
+    <timeout> seconds.
+    """
+
+    def __init__(self, name: str, plugin: GrottProxyAsyncPlugin, max_inflight: int = 10, timeout: float = 30.0,
+                 queue_size: int = 100, overflow: str = _GrottPluginDispatcher.OVERFLOW_DROP):
+        """
+        :param name: Plugin name
+        :param plugin: The plugin
+        :param max_inflight: Max concurrent calls
+        :param timeout: Max seconds for a single call
+        :param queue_size: Max calls waiting or running
+        :param overflow: Policy when the queue is full [drop/block]
+        """
+        super(GrottAsyncPluginRunner, self).__init__(name, plugin, GrottProxyAsyncPlugin, queue_size, overflow)
+        self.max_inflight = max(1, max_inflight)
+        self.timeout = timeout
+        self.inflight = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.latency = GrottHistogram()
+        self._tasks: Set[asyncio.Task] = set()
+        self._running: Optional[asyncio.Semaphore] = None
+
+    @property
+    def pending(self) -> int:
+        """ Calls waiting or running """
+        return len(self._tasks)
+
+    async def submit(self, *args, batch: bool = False):
+        if not await self._take_slot():
+            return
+        if self._running is None:
+            self._running = asyncio.Semaphore(self.max_inflight)
+        func = self.plugin.data_batch if batch else self.plugin.data
+        task = asyncio.get_running_loop().create_task(self._call(func, *args))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    async def _call(self, func, *args):
+        async with self._running:
+            self.inflight += 1
+            _start = perf_counter()
+            try:
+                await asyncio.wait_for(func(*args), self.timeout)
+                self.completed += 1
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                log.error(f'[Plugin {self.name}] timed out after {self.timeout}s')
+            except Exception as e:
+                self.errors += 1
+                log.error(f'[Plugin {self.name}] failed: {e}')
+            finally:
+                self.inflight -= 1
+                self.latency.observe(perf_counter() - _start)
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        self._slots.release()
+
+    async def drain(self, timeout: float):
+        """ Wait (up to timeout seconds) for the calls in progress """
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+    def shutdown(self):
+        """ Cancel the calls still in progress """
+        for task in list(self._tasks):
+            task.cancel()
+
+    def __str__(self):
+        return f'[Plugin {self.name}] running: {self.inflight}/{self.max_inflight} | ' \
+               f'queue: {self.pending}/{self.queue_size} | completed: {self.completed} | dropped: {self.dropped} | ' \
+               f'errors: {self.errors} | timeouts: {self.timeouts} | latency {self.latency}'
+
+
 class GrottPluginLoader:
     """
     Dynamic loader for plugins
@@ -16,10 +265,82 @@ class GrottPluginLoader:
     """
     __plugin_dir__ = 'plugins'
 
-    def __init__(self):
+    def __init__(self, config: 'GrottProxyConfig' = None):
+        self.config = config
         self.sync_plugins: Dict[str, GrottProxySyncPlugin] = {}
         self.async_plugins: Dict[str, GrottProxyAsyncPlugin] = {}
+        self.sync_executors: Dict[str, GrottPluginExecutor] = {}
+        self.async_runners: Dict[str, GrottAsyncPluginRunner] = {}
         self.load()
+        self._setup_executors()
+        self._setup_runners()
+
+    def _setup_executors(self):
+        for name, plugin in self.sync_plugins.items():
+            if self.config:
+                executor = GrottPluginExecutor(
+                    name, plugin,
+                    workers=self.config.plugin_option(name, 'workers', 1, int_=True),
+                    queue_size=self.config.plugin_option(name, 'queue_size', 100, int_=True),
+                    overflow=self.config.plugin_option(name, 'overflow', GrottPluginExecutor.OVERFLOW_DROP))
+            else:
+                executor = GrottPluginExecutor(name, plugin)
+            self._setup_batching(executor)
+            self.sync_executors.update({name: executor})
+
+    def _setup_runners(self):
+        for name, plugin in self.async_plugins.items():
+            if self.config:
+                runner = GrottAsyncPluginRunner(
+                    name, plugin,
+                    max_inflight=self.config.plugin_option(name, 'max_inflight', 10, int_=True),
+                    timeout=self.config.plugin_option(name, 'timeout', 30.0, float_=True),
+                    queue_size=self.config.plugin_option(name, 'queue_size', 100, int_=True),
+                    overflow=self.config.plugin_option(name, 'overflow', GrottAsyncPluginRunner.OVERFLOW_DROP))
+            else:
+                runner = GrottAsyncPluginRunner(name, plugin)
+            self._setup_batching(runner)
+            self.async_runners.update({name: runner})
+
+    def _setup_batching(self, dispatcher: _GrottPluginDispatcher):
+        """ Batch options from the config override the ones set in the plugin """
+        if dispatcher.collector and self.config:
+            collector = dispatcher.collector
+            collector.size = max(1, self.config.plugin_option(dispatcher.name, 'batch_size', collector.size,
+                                                              int_=True))
+            collector.window = self.config.plugin_option(dispatcher.name, 'batch_window', collector.window,
+                                                         int_=True)
+        if dispatcher.collector:
+            log.info(f'[Plugin {dispatcher.name}] batch delivery: {dispatcher.collector.size} records / '
+                     f'{dispatcher.collector.window}ms')
+
+    async def dispatch(self, packet: bytes, parsed_data: dict, log_: Logger):
+        """ Distribute the data from a packet to all plugins """
+        for executor in self.sync_executors.values():
+            await executor.dispatch(packet, parsed_data, log_)
+        for runner in self.async_runners.values():
+            await runner.dispatch(packet, parsed_data, log_)
+
+    async def flush(self):
+        """ Deliver all collected batches """
+        for dispatcher in list(self.sync_executors.values()) + list(self.async_runners.values()):
+            await dispatcher.flush()
+
+    async def drain(self, timeout: float = 5.0):
+        """ Wait for the async plugin calls in progress (e.g. the batches sent by flush) """
+        runners = [x.drain(timeout) for x in self.async_runners.values()]
+        if runners:
+            await asyncio.gather(*runners)
+
+    def shutdown(self):
+        for executor in self.sync_executors.values():
+            executor.shutdown()
+        for runner in self.async_runners.values():
+            runner.shutdown()
+
+    def stats(self):
+        """ Stats lines for all plugins """
+        return [str(x) for x in self.sync_executors.values()] + [str(x) for x in self.async_runners.values()]
 
     def load(self):
         if os.path.exists(self.__plugin_dir__) is False:
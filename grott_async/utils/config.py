@@ -1,5 +1,5 @@
 from configparser import ConfigParser
-from typing import Dict, List
+from typing import Dict, FrozenSet
 from ._dyn_loader import GrottPluginLoader
 
 
@@ -8,6 +8,12 @@ class _Sections:
     GROWATT = 'Growatt'
     MQTT = 'MQTT'
     DTC = 'DTCMapping'
+    PLUGINS = 'Plugins'
+    """ Defaults for all plugins. Per plugin overrides in [Plugins.<plugin name>] """
+    SPOOL = 'Spool'
+    """ Store-and-forward when the Growatt server is unreachable """
+    LOOP_MONITOR = 'LoopMonitor'
+    """ Event loop lag sampling and load shedding """
 
 
 class _OptionNames:
@@ -21,10 +27,65 @@ class _OptionNames:
     """ Topic for MQTT """
     BUFFERED = 'buffered'
     """ Send buffered data """
+    CONNECTIONS = 'connections'
+    """ Persistent connections to the MQTT broker """
+    QUEUE_SIZE = 'queue_size'
+    BATCH_SIZE = 'batch_size'
+    OVERFLOW = 'overflow'
+    """ What to do when the queue is full [drop_new/drop_old] (MQTT), [drop/block] (Plugins) """
     LOG_TO = 'log'
     LOG_LEVEL = 'log_level'
     LOG_FILE = 'log_filename'
+    LOG_QUEUE = 'log_queue'
+    """ Log records waiting to be written (all loggers) """
+    TRACE_SAMPLE = 'trace_sample'
+    """ Debug traces for 1 in N packets of a datalogger """
+    TRACE_FILE = 'trace_file'
+    """ Debug traces (packet dumps etc.) to a separate file """
+    METRICS_ADDRESS = 'metrics_address'
+    METRICS_PORT = 'metrics_port'
+    """ HTTP port of the metrics endpoint. 0 disables it """
     DATALOG_SEP = 'separate_logs'
+    PROCESS_QUEUE = 'process_queue'
+    """ Packets waiting to be processed (per datalogger) """
+    WORKERS = 'workers'
+    """ Proxy processes sharing the listen port """
+    LOOP = 'loop'
+    """ Event loop [auto/uvloop/asyncio] """
+    TRANSPORT = 'transport'
+    """ Client implementation [stream/protocol] """
+    CLIENT_IDLE = 'client_idle'
+    """ Seconds without data from a datalogger """
+    SERVER_IDLE = 'server_idle'
+    """ Seconds without data from the Growatt server """
+    DIRECTORY = 'directory'
+    MAX_SIZE = 'max_size'
+    """ MBs per datalogger """
+    REPLAY_RATE = 'replay_rate'
+    """ Frames per second """
+    RETRY = 'retry'
+    """ Seconds between the connection attempts """
+    POOL_SIZE = 'pool_size'
+    """ Connections to the Growatt server kept ready for new clients """
+    POOL_MAX_AGE = 'pool_max_age'
+    DNS_TTL = 'dns_ttl'
+    BACKOFF_MAX = 'backoff_max'
+    """ Max delay (seconds) after failed connects to the Growatt server """
+    INTERVAL = 'interval'
+    """ Seconds between two loop lag samples """
+    SHED_TRACES = 'shed_traces'
+    SKIP_BUFFERED = 'skip_buffered'
+    DEFER_LIVE = 'defer_live'
+    """ Loop lag thresholds (ms) of the shedding levels """
+    RECOVER = 'recover'
+    """ Seconds under a threshold before the shedding level is lowered """
+    MAX_DEFERRED = 'max_deferred'
+
+
+MQTT_OVERFLOW = ('drop_old', 'drop_new')
+""" Overflow policies of the MQTT queue (see GrottMQTTPublisher) """
+PLUGIN_OVERFLOW = ('drop', 'block')
+""" Overflow policies of the plugin queues (see GrottPluginExecutor/GrottAsyncPluginRunner) """
 
 
 class GrottProxyConfig:
@@ -32,15 +93,30 @@ class GrottProxyConfig:
     def __init__(self, ini_file: str = 'grott_async.ini'):
         self._file = ini_file
         self.parser = ConfigParser(allow_no_value=False)
-        self.dtc_mapping: Dict[int, List[int]] = {}
+        self.dtc_mapping: Dict[int, FrozenSet[int]] = {}
         self.listen_address = '0.0.0.0'
         self.listen_port = 5279
         self.log_level = 'debug'
         self.log_to = 'stdout'
         self.log_file = 'grott_proxy.log'
+        self.log_queue: int = 10000
+        self.trace_sample: int = 1
+        self.trace_file: str = ''
+        self.metrics_address: str = '127.0.0.1'
+        self.metrics_port: int = 0
         self.separate_logs = False
+        self.process_queue: int = 100
+        self.workers: int = 1
+        self.event_loop: str = 'auto'
+        self.transport: str = 'stream'
+        self.client_idle: int = 600
+        self.server_idle: int = 0
         self.growatt_srv: str = 'server.growatt.com'
         self.growatt_port: int = 5279
+        self.growatt_pool_size: int = 0
+        self.growatt_pool_max_age: int = 60
+        self.growatt_dns_ttl: int = 300
+        self.growatt_backoff_max: int = 60
         self.mqtt_server: str = '127.0.0.1'
         self.mqtt_port: int = 1883
         self.mqtt_auth: bool = False
@@ -48,18 +124,47 @@ class GrottProxyConfig:
         self.mqtt_pass: str = ''
         self.mqtt_buffered: bool = False
         self.mqtt_topic: str = 'grott/energy'
+        self.mqtt_connections: int = 1
+        self.mqtt_queue_size: int = 1000
+        self.mqtt_batch_size: int = 50
+        self.mqtt_overflow: str = 'drop_old'
+
+        self.spool_dir: str = 'spool'
+        self.spool_max_size: int = 10
+        self.spool_replay_rate: float = 5.0
+        self.spool_retry: int = 30
+
+        self.lag_interval: float = 0.5
+        self.lag_shed_traces: int = 100
+        self.lag_skip_buffered: int = 250
+        self.lag_defer_live: int = 500
+        self.lag_recover: float = 5.0
+        self.lag_max_deferred: int = 1000
 
         self._has_mqtt = False
         self._has_dtc = False
+        self._has_spool = False
         self.__parse()
         self.plugins: GrottPluginLoader = None  # noqa
 
+    def plugin_option(self, plugin: str, option: str, default, int_=False, float_=False):
+        """
+        Option for a plugin from [Plugins.<plugin>] with fallback to [Plugins]
+
+        :param plugin: Plugin name (the variable name in the plugin module)
+        :param option: Option name
+        :param default: Used if the option is not set in both sections
+        """
+        value = self._get_val(_Sections.PLUGINS, option, default, int_=int_, float_=float_)
+        return self._get_val(f'{_Sections.PLUGINS}.{plugin}', option, value, int_=int_, float_=float_)
+
     def __parse(self):
         self.parser.read(self._file)
         has_growatt = self.parser.has_section(_Sections.GROWATT)
         has_grott = self.parser.has_section(_Sections.GROTT)
         self.has_dtc = self.parser.has_section(_Sections.DTC)
         self.has_mqtt = self.parser.has_section(_Sections.MQTT)
+        self.has_spool = self.parser.has_section(_Sections.SPOOL)
 
         """ Proxy settings """
         if has_grott:
@@ -68,12 +173,33 @@ class GrottProxyConfig:
             self.log_to = self._get_val(_Sections.GROTT, _OptionNames.LOG_TO, self.log_to)
             self.log_level = self._get_val(_Sections.GROTT, _OptionNames.LOG_LEVEL, self.log_level)
             self.log_file = self._get_val(_Sections.GROTT, _OptionNames.LOG_FILE, self.log_file)
+            self.log_queue = self._get_val(_Sections.GROTT, _OptionNames.LOG_QUEUE, self.log_queue, int_=True)
+            self.trace_sample = self._get_val(_Sections.GROTT, _OptionNames.TRACE_SAMPLE, self.trace_sample,
+                                              int_=True)
+            self.trace_file = self._get_val(_Sections.GROTT, _OptionNames.TRACE_FILE, self.trace_file)
+            self.metrics_address = self._get_val(_Sections.GROTT, _OptionNames.METRICS_ADDRESS, self.metrics_address)
+            self.metrics_port = self._get_val(_Sections.GROTT, _OptionNames.METRICS_PORT, self.metrics_port, int_=True)
             self.separate_logs = self._get_val(_Sections.GROTT, _OptionNames.DATALOG_SEP, self.separate_logs, bool_=True)
+            self.process_queue = self._get_val(_Sections.GROTT, _OptionNames.PROCESS_QUEUE, self.process_queue,
+                                               int_=True)
+            self.workers = self._get_val(_Sections.GROTT, _OptionNames.WORKERS, self.workers, int_=True)
+            self.event_loop = self._get_val(_Sections.GROTT, _OptionNames.LOOP, self.event_loop)
+            self.transport = self._get_val(_Sections.GROTT, _OptionNames.TRANSPORT, self.transport)
+            self.client_idle = self._get_val(_Sections.GROTT, _OptionNames.CLIENT_IDLE, self.client_idle, int_=True)
+            self.server_idle = self._get_val(_Sections.GROTT, _OptionNames.SERVER_IDLE, self.server_idle, int_=True)
 
         """ Proxy forward settings """
         if has_growatt:
             self.growatt_srv = self._get_val(_Sections.GROWATT, _OptionNames.SERVER, self.growatt_srv)
             self.growatt_port = self._get_val(_Sections.GROWATT, _OptionNames.PORT, self.growatt_port)
+            self.growatt_pool_size = self._get_val(_Sections.GROWATT, _OptionNames.POOL_SIZE, self.growatt_pool_size,
+                                                   int_=True)
+            self.growatt_pool_max_age = self._get_val(_Sections.GROWATT, _OptionNames.POOL_MAX_AGE,
+                                                      self.growatt_pool_max_age, int_=True)
+            self.growatt_dns_ttl = self._get_val(_Sections.GROWATT, _OptionNames.DNS_TTL, self.growatt_dns_ttl,
+                                                 int_=True)
+            self.growatt_backoff_max = self._get_val(_Sections.GROWATT, _OptionNames.BACKOFF_MAX,
+                                                     self.growatt_backoff_max, int_=True)
 
         """ MQTT Options """
         if self.has_mqtt:
@@ -83,6 +209,45 @@ class GrottProxyConfig:
             self.mqtt_user = self._get_val(_Sections.MQTT, _OptionNames.USER, self.mqtt_user)
             self.mqtt_pass = self._get_val(_Sections.MQTT, _OptionNames.PASS, self.mqtt_pass)
             self.mqtt_topic = self._get_val(_Sections.MQTT, _OptionNames.TOPIC, self.mqtt_topic)
+            self.mqtt_connections = self._get_val(_Sections.MQTT, _OptionNames.CONNECTIONS, self.mqtt_connections,
+                                                  int_=True)
+            self.mqtt_queue_size = self._get_val(_Sections.MQTT, _OptionNames.QUEUE_SIZE, self.mqtt_queue_size,
+                                                 int_=True)
+            self.mqtt_batch_size = self._get_val(_Sections.MQTT, _OptionNames.BATCH_SIZE, self.mqtt_batch_size,
+                                                 int_=True)
+            self.mqtt_overflow = self._get_val(_Sections.MQTT, _OptionNames.OVERFLOW, self.mqtt_overflow)
+            if self.mqtt_overflow not in MQTT_OVERFLOW:
+                raise ValueError(f'[{_Sections.MQTT}] {_OptionNames.OVERFLOW} must be one of '
+                                 f'{"/".join(MQTT_OVERFLOW)}, got: {self.mqtt_overflow}')
+
+        """ Store-and-forward """
+        if self.has_spool:
+            self.spool_dir = self._get_val(_Sections.SPOOL, _OptionNames.DIRECTORY, self.spool_dir)
+            self.spool_max_size = self._get_val(_Sections.SPOOL, _OptionNames.MAX_SIZE, self.spool_max_size,
+                                                int_=True)
+            self.spool_replay_rate = self._get_val(_Sections.SPOOL, _OptionNames.REPLAY_RATE, self.spool_replay_rate,
+                                                   float_=True)
+            self.spool_retry = self._get_val(_Sections.SPOOL, _OptionNames.RETRY, self.spool_retry, int_=True)
+
+        """ Loop lag monitor (runs with the defaults if the section is missing) """
+        if self.parser.has_section(_Sections.LOOP_MONITOR):
+            section = _Sections.LOOP_MONITOR
+            self.lag_interval = self._get_val(section, _OptionNames.INTERVAL, self.lag_interval, float_=True)
+            self.lag_shed_traces = self._get_val(section, _OptionNames.SHED_TRACES, self.lag_shed_traces, int_=True)
+            self.lag_skip_buffered = self._get_val(section, _OptionNames.SKIP_BUFFERED, self.lag_skip_buffered,
+                                                   int_=True)
+            self.lag_defer_live = self._get_val(section, _OptionNames.DEFER_LIVE, self.lag_defer_live, int_=True)
+            self.lag_recover = self._get_val(section, _OptionNames.RECOVER, self.lag_recover, float_=True)
+            self.lag_max_deferred = self._get_val(section, _OptionNames.MAX_DEFERRED, self.lag_max_deferred,
+                                                  int_=True)
+
+        """ Plugins (the options are read by the plugin loader, see plugin_option) """
+        for section in self.parser.sections():
+            if section == _Sections.PLUGINS or section.startswith(f'{_Sections.PLUGINS}.'):
+                overflow = self._get_val(section, _OptionNames.OVERFLOW, PLUGIN_OVERFLOW[0])
+                if overflow not in PLUGIN_OVERFLOW:
+                    raise ValueError(f'[{section}] {_OptionNames.OVERFLOW} must be one of '
+                                     f'{"/".join(PLUGIN_OVERFLOW)}, got: {overflow}')
 
         """ DTC Maps """
         if self.has_dtc:
@@ -91,7 +256,7 @@ class GrottProxyConfig:
                 try:
                     dtc_map = self.parser.get(_Sections.DTC, dtc)
                     dtc = int(dtc)
-                    dtc_map = [int(x) for x in dtc_map.split(',')]
+                    dtc_map = frozenset([int(x) for x in dtc_map.split(',')])
                     self.dtc_mapping.update({dtc: dtc_map})
                 except ValueError:
                     continue
@@ -132,7 +297,7 @@ class GrottProxyConfig:
 
         The plugin loader uses a logger, so we call it after the logger setup
         """
-        self.plugins = GrottPluginLoader()
+        self.plugins = GrottPluginLoader(self)
 
     def __str__(self):
         base = f'''
@@ -141,9 +306,19 @@ class GrottProxyConfig:
         Listen port:    {self.listen_port}
         Forward to:     {self.growatt_srv}
         Forward port:   {self.growatt_port}
+        Forward pool:   {self.growatt_pool_size} (max age: {self.growatt_pool_max_age}s) | DNS TTL: {self.growatt_dns_ttl}s | backoff max: {self.growatt_backoff_max}s
         Log to:         {self.log_to}
         Log level:      {self.log_level}
+        Log queue:      {self.log_queue}
+        Traces:         1 in {self.trace_sample} packets -> {self.trace_file or 'log'}
         Separate logs:  {self.separate_logs}
+        Process queue:  {self.process_queue}
+        Workers:        {self.workers}
+        Event loop:     {self.event_loop}
+        Transport:      {self.transport}
+        Idle limits:    client {self.client_idle}s | server {self.server_idle}s
+        Metrics:        {f'http://{self.metrics_address}:{self.metrics_port}/metrics' if self.metrics_port else 'disabled'}
+        Loop monitor:   {f'every {self.lag_interval}s' if self.lag_interval > 0 else 'disabled'} | shed traces/skip buffered/defer live at {self.lag_shed_traces}/{self.lag_skip_buffered}/{self.lag_defer_live}ms | recover: {self.lag_recover}s
     '''
         if self.has_mqtt:
             base += f'''
@@ -154,11 +329,18 @@ class GrottProxyConfig:
         MQTT pass:      {self.mqtt_pass}
         MQTT buffered:  {self.mqtt_buffered}
         MQTT topic:     {self.mqtt_topic}
+        MQTT conns:     {self.mqtt_connections}
+        MQTT queue:     {self.mqtt_queue_size} (batch: {self.mqtt_batch_size}, overflow: {self.mqtt_overflow})
+        '''
+        if self.has_spool:
+            base += f'''
+        Spool dir:      {self.spool_dir} (max: {self.spool_max_size}MB per datalogger)
+        Spool replay:   {self.spool_replay_rate} frames/s | retry: {self.spool_retry}s
         '''
         if self.has_dtc:
             for dtc, map_ in self.dtc_mapping.items():
                 base += f'''
-        DTC code [{dtc}]: {map_}'''
+        DTC code [{dtc}]: {sorted(map_)}'''
 
         base += f'''
         
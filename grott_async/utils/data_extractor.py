@@ -2,8 +2,9 @@
 import enum
 import struct
 import datetime
+from functools import lru_cache
 from logging import getLogger
-from typing import List
+from typing import Dict, List, Optional, Union
 from .packet import GrottConstants
 
 
@@ -72,6 +73,10 @@ class GrottDataExtractor:
     """
 
     second_group_offset = 2
+    _unit = 2
+    """ Positions per byte of data (2 hex characters) """
+    _reg_width = 4
+    """ Positions occupied by a single (2 bytes) register """
 
     def __init__(self, hex_data: str, debug: bool = False):
         """
@@ -80,19 +85,33 @@ class GrottDataExtractor:
         :param debug: Print additional info during packet processing/data extraction
         """
         self.packet = ''.join([x.strip() for x in hex_data.split('\n')])
+        self._parse(debug)
+
+    def _parse(self, debug: bool):
         self.debug = debug
         self.data_start = 0
         self.registers_per_section = 0
         self.inverter = self.inv_auto_detect()
         self.registers: List[int] = []
+        self.reg_index: Dict[int, int] = {}
+        """ Register -> position in the data. Built once from all data markers """
         if self.inverter != InverterType.UNKNOWN:
             self.regmaps = self.map_extractor()
-
-            for map_ in self.regmaps:
-                self.registers += [x for x in range(map_.from_reg, map_.to_reg + 1)]
+            self._index_registers()
         else:
             self.regmaps = []
 
+    def _index_registers(self):
+        for map_ in self.regmaps:
+            self.registers += [x for x in range(map_.from_reg, map_.to_reg + 1)]
+            for reg_idx, reg in enumerate(range(map_.from_reg, map_.to_reg + 1)):
+                """ First section wins on overlapping maps """
+                self.reg_index.setdefault(reg, map_.data_from + reg_idx * self._reg_width)
+
+    def __contains__(self, register: int) -> bool:
+        """ True if the packet holds the register """
+        return register in self.reg_index
+
     def int_at(self, register: int):
         """ Try to extract an integer from the provided position """
         start, end = self._reg_boundary(register)
@@ -129,6 +148,14 @@ class GrottDataExtractor:
         except Exception as e:
             raise e
 
+    def _bytes_at(self, start: int, end: int) -> bytes:
+        """ Raw bytes between two positions in the data """
+        return bytes.fromhex(self.packet[start:end])
+
+    def _byte_at(self, idx: int) -> int:
+        """ Single byte (as int) at byte index <idx> """
+        return int(self.packet[idx * self._unit:(idx + 1) * self._unit], 16)
+
     def _reg_boundary(self, x: int, long=False, ascii_to=None):
         """
             Transform the ID to start/end positions in the plain
@@ -137,14 +164,14 @@ class GrottDataExtractor:
         x = self._translate_reg_to_pos(x)
 
         if ascii_to:
-            x_end = self._translate_reg_to_pos(ascii_to) + 4
+            x_end = self._translate_reg_to_pos(ascii_to) + self._reg_width
             if self.debug:
                 log.debug(f'ASCII end at: {x_end}')
         else:
             if long:
-                x_end = x + 8
+                x_end = x + 2 * self._reg_width
             else:
-                x_end = x + 4
+                x_end = x + self._reg_width
             if self.debug:
                 log.debug(f'Int/Long end at: {x_end}')
         if self.debug:
@@ -154,22 +181,22 @@ class GrottDataExtractor:
     @property
     def report(self) -> bool:
         """ True if we are dealing with a report packet """
-        return int(self.packet[14:16], 16) == 3
+        return self._byte_at(7) == 3
 
     @property
     def datapacket(self) -> bool:
         """ True if we are dealing with a datarecord """
-        return int(self.packet[14:16], 16) == 4
+        return self._byte_at(7) == 4
 
     @property
     def buffered(self) -> bool:
         """ True if this is a buffered packet """
-        return int(self.packet[14:16], 16) == 80
+        return self._byte_at(7) == 80
 
     @property
     def has_third_map(self) -> bool:
         """ True if the first marker/register map is prefixed with 03 """
-        return self.packet[self.data_start - 10:self.data_start - 8] == '03'
+        return self._byte_at(self.data_start // self._unit - 5) == 3
 
     @property
     def tstamp(self) -> str:
@@ -189,30 +216,34 @@ class GrottDataExtractor:
         except Exception as e:
             raise e
 
+    def _peek(self, position: int, hex_str: str) -> bool:
+        """ Check for a hex sequence at the given position """
+        return self.packet[position:position + len(hex_str)] == hex_str
+
     def map_extractor(self) -> List[GrottDataMarker]:
         """
         Extract the register maps from the packet
         """
-
-        marker = self.data_start - 10
-        reg_s, reg_e = struct.unpack('>hh', bytes.fromhex(self.packet[marker + 2:marker + 10]))
+        unit = self._unit
+        marker = self.data_start - 5 * unit
+        reg_s, reg_e = struct.unpack('>hh', self._bytes_at(marker + unit, marker + 5 * unit))
         num_registers = reg_e - reg_s + 1
         self.registers_per_section = num_registers
         """ Expose the registers as a class attribute """
-        regs = [GrottDataMarker(marker + 10, reg_s, reg_e)]
-        data_start = marker + 10
+        regs = [GrottDataMarker(marker + 5 * unit, reg_s, reg_e)]
+        data_start = marker + 5 * unit
 
         while True:
-            marker_next = num_registers * 4 + data_start
-            if marker_next + 8 > len(self.packet):
+            marker_next = num_registers * self._reg_width + data_start
+            if marker_next + 4 * unit > len(self.packet):
                 break
             if self.debug:
                 log.debug(f'Searching for next map @ {marker_next}')
-            reg_s, reg_e = struct.unpack('>hh', bytes.fromhex(self.packet[marker_next:marker_next + 8]))
+            reg_s, reg_e = struct.unpack('>hh', self._bytes_at(marker_next, marker_next + 4 * unit))
             """ Mapping for the start:end register in this section """
             if reg_e > reg_s:
-                regs.append(GrottDataMarker(marker_next + 8, reg_s, reg_e))
-            data_start = marker_next + 8
+                regs.append(GrottDataMarker(marker_next + 4 * unit, reg_s, reg_e))
+            data_start = marker_next + 4 * unit
             num_registers = reg_e - reg_s + 1
 
         return regs
@@ -236,13 +267,13 @@ class GrottDataExtractor:
             if self._in_header('020000007c'):
                 """ All other for which the first group is in the range 0-124 """
                 """ peek into the next map """
-                next_map = self.data_start + 500  # 125 words * 4
-                if self.packet[next_map:next_map + 8] == '007d00f9':
-                    if self.packet[7] == '5':
+                next_map = self.data_start + 125 * self._reg_width
+                if self._peek(next_map, '007d00f9'):
+                    if (self._byte_at(3) & 0x0f) == 5:
                         return InverterType.MID
-                    elif self.packet[7] == '6':
+                    elif (self._byte_at(3) & 0x0f) == 6:
                         return InverterType.MAX
-                elif self.packet[next_map:next_map + 8] == '03e80464':
+                elif self._peek(next_map, '03e80464'):
                     """ CAN BE SPH/MIX - SPH seems more commonly used
                         Return SPH for now 
                     """
@@ -258,15 +289,15 @@ class GrottDataExtractor:
                 return InverterType.SPF
             elif self._in_header('020000007c'):
                 """ All with first group 0-124 """
-                next_map = self.data_start + 500
-                if self.packet[next_map:next_map + 8] == '0bb80c34':
+                next_map = self.data_start + 125 * self._reg_width
+                if self._peek(next_map, '0bb80c34'):
                     return InverterType.MIN
-                elif self.packet[next_map:next_map + 8] == '007d00f9':
-                    if self.packet[7] == '5':
+                elif self._peek(next_map, '007d00f9'):
+                    if (self._byte_at(3) & 0x0f) == 5:
                         return InverterType.MID
-                    elif self.packet[7] == '6':
+                    elif (self._byte_at(3) & 0x0f) == 6:
                         return InverterType.MAX
-                elif self.packet[next_map:next_map + 8] == '03e80464':
+                elif self._peek(next_map, '03e80464'):
                     """ Need more info about the storage type inverters 
                         and their report (03) packet
                         MIX / SPA / SPH all use the [1000:1124] range 
@@ -286,26 +317,151 @@ class GrottDataExtractor:
         Uses the new data markers. Much cleaner and accurate code
         """
 
-        for _map in self.regmaps:
-            if _map.from_reg <= reg <= _map.to_reg:
-                reg_idx = [x for x in range(_map.from_reg, _map.to_reg + 1)].index(reg)
-                if self.debug:
-                    log.debug(f'GrottDataMarker pos: {_map.data_from + reg_idx * 4}')
-                return _map.data_from + reg_idx * 4
-
-        raise InvalidRegister(f'This packet has no register with ID <{reg}>')
+        try:
+            position = self.reg_index[reg]
+        except KeyError:
+            raise InvalidRegister(f'This packet has no register with ID <{reg}>')
+        if self.debug:
+            log.debug(f'GrottDataMarker pos: {position}')
+        return position
 
     def _packet_tstamp(self):
         if self.inverter != InverterType.UNKNOWN:
-            offset = self.data_start - 10
+            offset = self.data_start - 5 * self._unit
+            dt_bytes = self._bytes_at(offset - 6 * self._unit, offset)
             try:
-                dt_struct = '-'.join([str(x) for x in bytes.fromhex(self.packet[offset-12:offset])])
+                dt_struct = '-'.join([str(x) for x in dt_bytes])
                 dt_object = datetime.datetime.strptime(dt_struct, '%y-%m-%d-%H-%M-%S').isoformat()
             except ValueError:
-                log.error(f'[DataExtraction] Cannot get date from: {self.packet[offset-12:offset]}')
+                log.error(f'[DataExtraction] Cannot get date from: {dt_bytes.hex()}')
                 log.info(f'[DataExtraction] will use server time.')
                 dt_object = datetime.datetime.now().isoformat(timespec='seconds')
 
             return dt_object
         return '1970-1-1T00:00:00'
 
+
+
+@lru_cache(maxsize=None)
+def _unhex(hex_str: str) -> bytes:
+    return bytes.fromhex(hex_str)
+
+
+_U16 = struct.Struct('>H')
+_I32 = struct.Struct('>i')
+
+
+class GrottPacketLayout:
+    """
+    Section layout detected in a decrypted packet (inverter type, data markers,
+    register positions).
+
+    The layout of the packets from a datalogger does not change between packets.
+    It is detected once and reused as long as the fingerprint matches:
+    protocol version, packet type, packet length and the bytes of all data markers.
+    """
+
+    __slots__ = ('inverter', 'data_start', 'regmaps', 'registers_per_section', 'registers', 'reg_index',
+                 'fingerprint')
+
+    def __init__(self, parsed: 'GrottBinaryDataExtractor'):
+        self.inverter = parsed.inverter
+        self.data_start = parsed.data_start
+        self.regmaps = parsed.regmaps
+        self.registers_per_section = parsed.registers_per_section
+        self.registers = parsed.registers
+        self.reg_index = parsed.reg_index
+        self.fingerprint = self._fingerprint(parsed.packet)
+
+    def _fingerprint(self, data: Union[bytes, memoryview]) -> tuple:
+        return (bytes(data[2:4]), bytes(data[6:8]), len(data), bytes(data[self.data_start - 5:self.data_start])) + \
+            tuple(bytes(data[m.data_from - 4:m.data_from]) for m in self.regmaps[1:])
+
+    def matches(self, data: Union[bytes, memoryview]) -> bool:
+        """ True if the packet has the same layout """
+        return len(data) == self.fingerprint[2] and self._fingerprint(data) == self.fingerprint
+
+    def apply(self, parsed: 'GrottBinaryDataExtractor'):
+        parsed.inverter = self.inverter
+        parsed.data_start = self.data_start
+        parsed.regmaps = self.regmaps
+        parsed.registers_per_section = self.registers_per_section
+        parsed.registers = self.registers
+        parsed.reg_index = self.reg_index
+
+
+class GrottBinaryDataExtractor(GrottDataExtractor):
+    """
+    Data extractor working directly on the decrypted packet bytes.
+
+    Same results as GrottDataExtractor without the hex round-trip. All positions
+    (markers, data_start, register offsets) are byte offsets and the registers
+    are decoded with struct at these offsets.
+
+    Examples:
+    >>> extractor = GrottBinaryDataExtractor(packet.decrypted_packet())
+    >>> extractor.int_at(45)
+    2022
+    """
+
+    _unit = 1
+    _reg_width = 2
+
+    def __init__(self, data: Union[bytes, memoryview], debug: bool = False, layout: GrottPacketLayout = None):
+        """
+
+        :param data: Decrypted Grott packet
+        :param debug: Print additional info during packet processing/data extraction
+        :param layout: Layout from a previous packet of the same datalogger.
+            Used instead of the auto detection if the packet matches it
+        """
+        self.packet = data
+        self.layout: Optional[GrottPacketLayout] = None
+        """ Layout of this packet (None for unknown inverters) """
+        if layout is not None and layout.matches(data):
+            self.debug = debug
+            layout.apply(self)
+            self.layout = layout
+            return
+        self._parse(debug)
+        if self.inverter != InverterType.UNKNOWN:
+            self.layout = GrottPacketLayout(self)
+
+    def int_at(self, register: int):
+        """ Try to extract an integer from the provided position """
+        return _U16.unpack_from(self.packet, self._translate_reg_to_pos(register))[0]
+
+    def long_at(self, register: int):
+        """
+            Try extraction of a long signed integer from the specified
+            register
+        """
+        return _I32.unpack_from(self.packet, self._translate_reg_to_pos(register))[0]
+
+    def ascii_at(self, s_register: int, e_register: int):
+        """
+            Extract ASCII string from the data enclosed between the
+            start and end registers.
+
+        :param s_register: Start of the ASCII string
+        :param e_register: End register of the string.
+        """
+        start, end = self._reg_boundary(s_register, ascii_to=e_register)
+        return bytes(self.packet[start:end]).decode()
+
+    def _bytes_at(self, start: int, end: int) -> bytes:
+        return bytes(self.packet[start:end])
+
+    def _byte_at(self, idx: int) -> int:
+        return self.packet[idx]
+
+    def _peek(self, position: int, hex_str: str) -> bool:
+        needle = _unhex(hex_str)
+        return self.packet[position:position + len(needle)] == needle
+
+    def _in_header(self, hex_str: str) -> bool:
+        position = bytes(self.packet[:GrottConstants.HEADER_MAX_LEN // 2]).find(_unhex(hex_str))
+        if position < 0:
+            return False
+        self.data_start = position + 5
+        return True
@@ -0,0 +1,163 @@
+"""
+Grott - compiled decode plans
+"""
+
+import struct
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Optional, Tuple
+from .packet import GrottRegister, RegType
+from .data_extractor import GrottBinaryDataExtractor
+
+_RAW = 0
+_FLOAT = 1
+_TEXT = 2
+_FORMAT = 3
+
+
+class GrottDecodePlan:
+    """
+    Decode plan for a register map, a DTC filter and a section layout.
+
+    All register offsets are resolved once. The numeric registers are read with a
+    single precomputed struct (registers overlapping another one are read on their
+    own) and the values are scaled in one pass.
+
+    Examples:
+    >>> plan = GrottDecodePlan(map_04_125, None, GrottBinaryDataExtractor(data))
+    >>> plan.decode(data)
+    {'pvstatus': 1, 'in_power': 1234.5, ...}
+    """
+
+    __slots__ = ('names', '_kinds', '_args', '_struct', '_base', '_slots', '_extra')
+
+    def __init__(self, mapping: Dict[int, GrottRegister], reg_filter: Optional[FrozenSet[int]],
+                 parsed: GrottBinaryDataExtractor):
+        """
+        :param mapping: Register map (see protocol.py)
+        :param reg_filter: Registers to be extracted. None for all registers in the map
+        :param parsed: Extractor with the layout of the packet
+        :raises InvalidRegister: if a register from the map is missing in the layout
+        """
+        names = []
+        kinds = []
+        args = []
+        fields = []
+        """ (offset, struct code, size, output slot) """
+        for k in mapping.values():
+            if reg_filter is not None and k.id not in reg_filter:
+                continue
+            offset = parsed._translate_reg_to_pos(k.id)
+            if k.type == RegType.TEXT:
+                """ Same boundaries as ascii_at(k.id, k.id + k.length) """
+                size = parsed._translate_reg_to_pos(k.id + k.length) + parsed._reg_width - offset
+                code = f'{size}s'
+            elif k.length == 1:
+                size, code = 2, 'H'
+            elif k.length == 2:
+                size, code = 4, 'i'
+            else:
+                continue
+
+            if k.type == RegType.TEXT:
+                kind, arg = _TEXT, None
+            elif k.type == RegType.FLOAT:
+                kind, arg = _FLOAT, k.divide
+            elif k.type == RegType.INT:
+                kind, arg = _RAW, None
+            else:
+                kind, arg = _FORMAT, k.format
+            fields.append((offset, code, size, len(names)))
+            names.append(k.description)
+            kinds.append(kind)
+            args.append(arg)
+
+        fields.sort()
+        fmt = '>'
+        slots = []
+        extra = []
+        self._base = fields[0][0] if fields else 0
+        cursor = self._base
+        for offset, code, size, slot in fields:
+            if offset < cursor:
+                """ Overlaps the previous register """
+                extra.append((slot, struct.Struct(f'>{code}'), offset))
+                continue
+            if offset > cursor:
+                fmt += f'{offset - cursor}x'
+            fmt += code
+            cursor = offset + size
+            slots.append(slot)
+
+        self.names: Tuple[str, ...] = tuple(names)
+        self._kinds = tuple(kinds)
+        self._args = tuple(args)
+        self._struct = struct.Struct(fmt)
+        self._slots = tuple(slots)
+        self._extra = tuple(extra)
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        """
+        Extract all registers of the plan
+
+        :param data: Decrypted packet with the same layout as the one used for the plan
+        :return: description -> value (same as GrottRegister.format)
+        """
+        values = [None] * len(self.names)
+        for slot, value in zip(self._slots, self._struct.unpack_from(data, self._base)):
+            values[slot] = value
+        for slot, reg_struct, offset in self._extra:
+            values[slot] = reg_struct.unpack_from(data, offset)[0]
+
+        result = {}
+        for name, kind, arg, value in zip(self.names, self._kinds, self._args, values):
+            if kind == _FLOAT:
+                result[name] = round(value / arg, 3)
+            elif kind == _RAW:
+                result[name] = value
+            elif kind == _TEXT:
+                result[name] = value.decode()
+            else:
+                result[name] = arg(value)
+        return result
+
+
+class GrottDecodePlanCache:
+    """
+    Bounded LRU cache for decode plans keyed by the layout fingerprint
+    (register map, DTC filter, data markers)
+    """
+
+    def __init__(self, maxsize: int = 64):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._plans: 'OrderedDict[tuple, GrottDecodePlan]' = OrderedDict()
+
+    def get(self, mapping: Dict[int, GrottRegister], reg_filter: Optional[FrozenSet[int]],
+            parsed: GrottBinaryDataExtractor) -> GrottDecodePlan:
+        """
+        Get (or compile) the decode plan for this packet layout
+
+        :param mapping: Register map (see protocol.py)
+        :param reg_filter: Registers to be extracted. None for all registers in the map
+        :param parsed: Extractor for the packet
+        """
+        key = (id(mapping), reg_filter, tuple((m.data_from, m.from_reg, m.to_reg) for m in parsed.regmaps))
+        try:
+            plan = self._plans[key]
+        except KeyError:
+            self.misses += 1
+            plan = GrottDecodePlan(mapping, reg_filter, parsed)
+            self._plans[key] = plan
+            if len(self._plans) > self.maxsize:
+                self._plans.popitem(last=False)
+            return plan
+        self.hits += 1
+        self._plans.move_to_end(key)
+        return plan
+
+    def __len__(self):
+        return len(self._plans)
+
+    def __str__(self):
+        return f'Decode plans: {len(self._plans)}/{self.maxsize} | hits: {self.hits} | misses: {self.misses}'
@@ -0,0 +1,38 @@
+"""
+Grott - event loop selection
+"""
+
+import asyncio
+import logging
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+log = logging.getLogger('grott')
+
+LOOP_AUTO = 'auto'
+""" uvloop if installed, the default asyncio loop otherwise """
+LOOP_UVLOOP = 'uvloop'
+LOOP_ASYNCIO = 'asyncio'
+EVENT_LOOPS = (LOOP_AUTO, LOOP_UVLOOP, LOOP_ASYNCIO)
+
+
+def setup_event_loop(name: str = LOOP_AUTO) -> str:
+    """
+    Set the event loop policy used by asyncio.run()
+
+    :param name: auto/uvloop/asyncio
+    :return: The loop which will be used (uvloop/asyncio)
+    """
+    if name not in EVENT_LOOPS:
+        log.error(f'Unknown event loop "{name}". Using {LOOP_AUTO}')
+        name = LOOP_AUTO
+    if name != LOOP_ASYNCIO:
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return LOOP_UVLOOP
+        if name == LOOP_UVLOOP:
+            log.warning('uvloop is not installed. Using the default asyncio loop')
+    asyncio.set_event_loop_policy(None)
+    return LOOP_ASYNCIO
@@ -0,0 +1,159 @@
+"""
+Grott - stream framing
+"""
+
+import asyncio
+from typing import List, Tuple
+from .packet import GrottConstants
+
+
+class GrottFrameBuffer:
+    """
+    Incremental framer for a Growatt TCP stream.
+
+    TCP does not preserve message boundaries. Several datalogger frames can arrive
+    in a single read or a frame can be split over two reads. The framer uses the
+    length field from the header (bytes [4:6]) to cut the stream into whole frames.
+    Only the frames of the protocols 5/6 end with a CRC (see frame_length).
+
+    Complete frames are returned as memoryview slices over an immutable ``bytes``
+    object, so they can be forwarded (or kept) without copying. Only the tail of a
+    split frame is copied into the internal (reused) carry buffer.
+
+    Examples:
+    >>> framer = GrottFrameBuffer()
+    >>> frames = framer.feed(data)
+    >>> for frame in frames:
+    ...     writer.write(frame)
+    """
+
+    def __init__(self):
+        self._carry = bytearray()
+
+    @property
+    def pending(self) -> int:
+        """ Bytes waiting for the rest of their frame """
+        return len(self._carry)
+
+    def feed(self, data: bytes) -> List[memoryview]:
+        """
+        Add a chunk read from the socket and get all frames completed by it.
+
+        A header with a length which cannot belong to a Growatt frame is not
+        dropped. The remaining data is returned as is (single frame) as the proxy
+        must stay transparent for the peers.
+
+        :param data: Bytes as received from the socket
+        :type data: bytes
+        :return: Complete frames (may be empty)
+        :rtype: List[memoryview]
+        """
+        if self._carry:
+            self._carry += data
+            data = bytes(self._carry)
+            self._carry.clear()
+        view = memoryview(data)
+        frames, pos = self.split(view, len(view))
+        if pos < len(view):
+            self._carry += view[pos:]
+        return frames
+
+    @staticmethod
+    def frame_length(view: memoryview, pos: int) -> int:
+        """
+        Length of the frame starting at pos (the header must be in the buffer)
+
+        :return: Header + data length + CRC (protocols 5/6 only)
+        """
+        data_len = (view[pos + 4] << 8) | view[pos + 5]
+        if ((view[pos + 2] << 8) | view[pos + 3]) in GrottConstants.CRC_PROTOCOLS:
+            return GrottConstants.HEADER_LEN + data_len + GrottConstants.CRC_LEN
+        return GrottConstants.HEADER_LEN + data_len
+
+    @staticmethod
+    def split(view: memoryview, total: int) -> Tuple[List[memoryview], int]:
+        """
+        Cut the complete frames from the beginning of a buffer
+
+        :param view: Buffer with the stream data
+        :param total: Bytes of stream data in the buffer
+        :return: Frames (slices of view) and the position of the first partial frame
+        """
+        frames = []
+        pos = 0
+        while total - pos >= GrottConstants.HEADER_LEN:
+            frame_len = GrottFrameBuffer.frame_length(view, pos)
+            if frame_len - GrottConstants.HEADER_LEN < GrottConstants.TYPE_LEN:
+                """ Not a Growatt header. Pass everything through """
+                frames.append(view[pos:total])
+                return frames, total
+            if total - pos < frame_len:
+                break
+            frames.append(view[pos:pos + frame_len])
+            pos += frame_len
+        return frames, pos
+
+    def reset(self):
+        """ Drop any partial frame """
+        self._carry.clear()
+
+
+class GrottFrameProtocol(asyncio.BufferedProtocol):
+    """
+    Buffered protocol which cuts the Growatt frames in place.
+
+    The data is received directly into a preallocated buffer (get_buffer) and the
+    complete frames are passed to frames_received as memoryview slices over it.
+    Only the tail of a split frame is moved to the start of the buffer.
+
+    The buffer is small (buffer_size) and is replaced by a larger one only when a
+    split frame does not fit in it. It goes back to buffer_size after that frame.
+
+    The frames are valid only during the frames_received call. A transport which
+    could not send a frame right away may keep a reference to it, so the buffer
+    is replaced by a new one when the peer transport has buffered data.
+    """
+
+    buffer_size = 8192
+    """ Initial buffer. Larger than the usual data packets """
+
+    def __init__(self):
+        self.transport: asyncio.Transport = None  # noqa
+        self.peer: asyncio.WriteTransport = None  # noqa
+        """ Transport to which the frames are forwarded """
+        self._buffer = bytearray(self.buffer_size)
+        self._view = memoryview(self._buffer)
+        self._end = 0
+        self.buffers = 1
+        """ Allocated buffers (stats) """
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        self._end += nbytes
+        frames, pos = GrottFrameBuffer.split(self._view, self._end)
+        if frames:
+            self.frames_received(frames)
+        tail = self._end - pos
+        needed = GrottFrameBuffer.frame_length(self._view, pos) if tail >= GrottConstants.HEADER_LEN else 0
+        """ Size of the split frame (if its header is known) """
+        size = len(self._buffer)
+        if (frames and self.peer is not None and self.peer.get_write_buffer_size()) \
+                or needed > size or needed <= self.buffer_size < size:
+            """ The peer may still reference the frames, a larger frame or back to buffer_size """
+            buffer = bytearray(max(self.buffer_size, needed))
+            buffer[:tail] = self._view[pos:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+            self.buffers += 1
+        elif pos:
+            self._buffer[:tail] = self._buffer[pos:self._end]
+        self._end = tail
+
+    def frames_received(self, frames: List[memoryview]):
+        """ Called with the frames completed by the last read """
+        raise NotImplementedError
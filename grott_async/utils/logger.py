@@ -1,12 +1,179 @@
 import sys
+import atexit
+import copy
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+from collections import Counter
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from typing import Dict, List, Optional
+
+
+class GrottLogQueue(queue.Queue):
+    """
+    Log records waiting to be written. Never blocks the logging thread.
+
+    When the queue is full the least severe record is dropped - the new one
+    if nothing less severe is queued, otherwise the oldest of the least severe
+    queued records.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        super(GrottLogQueue, self).__init__()
+        """ Unbounded for queue.Queue. The limit is applied in put() """
+        self.limit = maxsize
+        self.dropped = 0
+        self._levels = Counter()
+        """ Level -> queued records """
+
+    def put(self, record: Optional[logging.LogRecord], block=True, timeout=None):
+        with self.mutex:
+            if record is not None and 0 < self.limit <= self._qsize():
+                lowest = min(lvl for lvl, cnt in self._levels.items() if cnt)
+                self.dropped += 1
+                if lowest >= record.levelno:
+                    return
+                for idx, queued in enumerate(self.queue):
+                    if queued is not None and queued.levelno == lowest:
+                        del self.queue[idx]
+                        self._levels[lowest] -= 1
+                        self.unfinished_tasks -= 1
+                        break
+            self._put(record)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _put(self, record: Optional[logging.LogRecord]):
+        self.queue.append(record)
+        if record is not None:
+            self._levels[record.levelno] += 1
+
+    def _get(self) -> Optional[logging.LogRecord]:
+        record = self.queue.popleft()
+        if record is not None:
+            self._levels[record.levelno] -= 1
+        return record
+
+
+class _GrottQueueHandler(QueueHandler):
+    """
+    Queues a copy of the record with the message and the traceback already
+    formatted (the args and the frames must not be used by the listener thread).
+    The rest (time, level etc.) is formatted by the handler in the listener thread.
+    """
+
+    _formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _GrottLogRouter(logging.Handler):
+    """ Passes every record to the handler of its logger (listener thread) """
+
+    def __init__(self):
+        super(_GrottLogRouter, self).__init__()
+        self.routes: Dict[str, logging.Handler] = {}
+        self._cache: Dict[str, Optional[logging.Handler]] = {}
+        """ Logger name -> handler of the logger or of its closest parent """
+        self._retired: List[logging.Handler] = []
+        """ Replaced handlers. Closed by the listener thread which may still be using them """
+
+    def route(self, logger_name: str, handler: logging.Handler):
+        old = self.routes.get(logger_name)
+        self.routes[logger_name] = handler
+        self._cache = {}
+        if old is not None and old is not handler:
+            with self.lock:
+                self._retired.append(old)
+
+    def close_retired(self):
+        with self.lock:
+            retired, self._retired = self._retired, []
+        for handler in retired:
+            handler.close()
+
+    def _lookup(self, name: str) -> Optional[logging.Handler]:
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        handler = None
+        parent = name
+        while parent:
+            handler = self.routes.get(parent)
+            if handler is not None:
+                break
+            parent = parent.rpartition('.')[0]
+        self._cache[name] = handler
+        return handler
+
+    def handle(self, record: logging.LogRecord):
+        if self._retired:
+            self.close_retired()
+        handler = self._lookup(record.name)
+        if handler is not None:
+            handler.handle(record)
+
+    def emit(self, record: logging.LogRecord):
+        self.handle(record)
+
+
+class GrottLogPipeline:
+    """
+    All log files/streams are written by a single background thread.
+
+    The loggers only format the message and put the records in a bounded queue
+    (GrottLogQueue). The line formatting, the writes and the file rotation are
+    done by a QueueListener thread which passes every record to the handler of
+    its logger.
+    """
+
+    def __init__(self, queue_size: int = 10000):
+        self.queue = GrottLogQueue(queue_size)
+        self.handler = _GrottQueueHandler(self.queue)
+        self.router = _GrottLogRouter()
+        self.listener = QueueListener(self.queue, self.router)
+        self.listener.start()
+        self._running = True
+        atexit.register(self.stop)
+
+    def attach(self, logger: logging.Logger, handler: logging.Handler):
+        """ Write the records of <logger> with <handler> (in the listener thread) """
+        self.router.route(logger.name, handler)
+        if len(logger.handlers) == 0:
+            logger.addHandler(self.handler)
+        else:
+            logger.handlers[0] = self.handler
+
+    def stop(self):
+        """ Write the queued records and stop the thread """
+        if self._running:
+            self._running = False
+            self.listener.stop()
+            self.router.close_retired()
+
+    @property
+    def dropped(self) -> int:
+        return self.queue.dropped
+
+    def __str__(self):
+        return f'Log queue: {self.queue.qsize()}/{self.queue.limit} | dropped: {self.queue.dropped}'
 
 
 class GrottLogger:
 
+    _pipeline: GrottLogPipeline = None
+    """ Shared by all loggers of the process """
+
     def __init__(self, output: str = 'stdout', fname: str = 'grott_proxy_async.log', level: str='critical',
-                 logger_name=None, f_size: int=20, keep: int=4):
+                 logger_name=None, f_size: int=20, keep: int=4, queue_size: int = 10000):
         """
         Logger with options to send everything to stdout or to file.
         If file is selected then a Rotating file handler will be used
@@ -24,6 +191,9 @@ class GrottLogger:
         :type f_size: int (optional)
         :param keep: How many files should be kept (default: 5)
         :type keep: int (optional)
+        :param queue_size: Max log records waiting to be written. Used by the first logger
+                           which starts the shared pipeline (see GrottLogPipeline)
+        :type queue_size: int (optional)
 
         """
         self._f_size = f_size
@@ -38,8 +208,16 @@ class GrottLogger:
             self.log = logging.getLogger('grott')
             self._logger_name = 'grott'
         self.ouput = output
+        self._queue_size = queue_size
         self.__setup()
 
+    @classmethod
+    def pipeline(cls, queue_size: int = 10000) -> GrottLogPipeline:
+        """ The shared log pipeline (started on first use) """
+        if cls._pipeline is None:
+            cls._pipeline = GrottLogPipeline(queue_size)
+        return cls._pipeline
+
     def __setup(self):
         if self.level < 20:
             """ DEBUG """
@@ -55,7 +233,5 @@ class GrottLogger:
             handler = logging.StreamHandler(sys.stdout)
 
         handler.setFormatter(formatter)
-        if len(self.log.handlers) == 0:
-            self.log.addHandler(handler)
-        else:
-            self.log.handlers[0] = handler
+        """ The handler is used by the pipeline thread. The logger only queues the records """
+        self.pipeline(self._queue_size).attach(self.log, handler)
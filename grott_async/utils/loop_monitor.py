@@ -0,0 +1,157 @@
+"""
+Grott - event loop lag monitor and load shedding
+"""
+
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
+from typing import Awaitable, Callable, Deque, List, Tuple
+from .stats import GrottHistogram
+
+log = logging.getLogger('grott')
+
+
+class GrottLoopMonitor:
+    """
+    Measures the event loop lag (how late a scheduled wakeup runs) and sheds
+    the optional work of the proxy while the loop is saturated.
+
+    The shedding is progressive. Each threshold enables one more level:
+
+    1. SHED_TRACES - debug traces are not written (see GrottTracer)
+    2. SKIP_BUFFERED - the buffered data packets are forwarded but not extracted
+    3. DEFER_LIVE - the live data packets are queued (up to <max_deferred>) and
+       decoded/dispatched in order when the lag is back under the threshold
+
+    A level is entered on the first sample above its threshold and left after
+    <recover> seconds under it. Forwarding to Growatt is never shed.
+
+    Examples:
+    >>> monitor = GrottLoopMonitor(thresholds=(0.1, 0.25, 0.5))
+    >>> loop.create_task(monitor.run())
+    >>> if monitor.defer_live:
+    ...     monitor.defer(client.decode_packet, packet, False)
+    """
+
+    NORMAL = 0
+    SHED_TRACES = 1
+    SKIP_BUFFERED = 2
+    DEFER_LIVE = 3
+    LEVELS = ('normal', 'shed_traces', 'skip_buffered', 'defer_live')
+
+    LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, interval: float = 0.5, thresholds: Tuple[float, float, float] = (0.1, 0.25, 0.5),
+                 recover: float = 5, max_deferred: int = 1000):
+        """
+        :param interval: Seconds between two samples. 0 disables the monitor
+        :param thresholds: Lag (seconds) of SHED_TRACES, SKIP_BUFFERED and DEFER_LIVE
+        :param recover: Seconds under the threshold before a level is left
+        :param max_deferred: Deferred live packets. The oldest are dropped when full
+        """
+        self.interval = interval
+        self.thresholds = tuple(thresholds)
+        self.recover = recover
+        self.level = self.NORMAL
+        self.lag = GrottHistogram(self.LAG_BUCKETS)
+        self.last_lag = 0.0
+        self.events: List[int] = [0] * len(self.LEVELS)
+        """ How many times each level was entered """
+        self.traces_shed = 0
+        self.buffered_skipped = 0
+        self.live_deferred = 0
+        self.deferred_dropped = 0
+        self.deferred: Deque[Tuple[Callable[..., Awaitable], tuple]] = deque()
+        self.max_deferred = max_deferred
+        self._high_at = 0.0
+        """ Last sample at or above the current level """
+        self._drain_task: asyncio.Task = None  # noqa
+
+    @property
+    def shed_traces(self) -> bool:
+        return self.level >= self.SHED_TRACES
+
+    @property
+    def skip_buffered(self) -> bool:
+        return self.level >= self.SKIP_BUFFERED
+
+    @property
+    def defer_live(self) -> bool:
+        """ True also while older deferred packets are waiting (keeps the order) """
+        return self.level >= self.DEFER_LIVE or len(self.deferred) > 0
+
+    def level_for(self, lag: float) -> int:
+        level = self.NORMAL
+        for threshold in self.thresholds:
+            if threshold <= 0 or lag < threshold:
+                break
+            level += 1
+        return level
+
+    def update(self, lag: float, now: float):
+        """ Apply a sample """
+        self.last_lag = lag
+        self.lag.observe(lag)
+        level = self.level_for(lag)
+        if level >= self.level:
+            self._high_at = now
+            if level > self.level:
+                for entered in range(self.level + 1, level + 1):
+                    self.events[entered] += 1
+                log.warning(f'[LoopMonitor] Loop lag {round(lag * 1000, 1)}ms. '
+                            f'Shedding level {self.LEVELS[self.level]} -> {self.LEVELS[level]}')
+                self.level = level
+        elif now - self._high_at >= self.recover:
+            log.info(f'[LoopMonitor] Loop lag {round(lag * 1000, 1)}ms. '
+                     f'Shedding level {self.LEVELS[self.level]} -> {self.LEVELS[level]}')
+            self.level = level
+            self._high_at = now
+        if self.level < self.DEFER_LIVE and self.deferred and self._drain_task is None:
+            self._drain_task = asyncio.get_running_loop().create_task(self._drain())
+
+    def defer(self, func: Callable[..., Awaitable], *args):
+        """ Queue a call (e.g. live data decoding) until the loop has recovered """
+        if len(self.deferred) >= self.max_deferred:
+            self.deferred.popleft()
+            self.deferred_dropped += 1
+        self.deferred.append((func, args))
+        self.live_deferred += 1
+
+    async def _drain(self):
+        try:
+            while self.deferred and self.level < self.DEFER_LIVE:
+                func, args = self.deferred.popleft()
+                try:
+                    await func(*args)
+                except Exception as e:
+                    log.error(f'[LoopMonitor] Deferred call failed: {e}')
+                await asyncio.sleep(0)
+        finally:
+            self._drain_task = None
+
+    async def flush(self):
+        """ Run all deferred calls (on shutdown) """
+        while self.deferred:
+            func, args = self.deferred.popleft()
+            try:
+                await func(*args)
+            except Exception as e:
+                log.error(f'[LoopMonitor] Deferred call failed: {e}')
+
+    async def run(self):
+        if self.interval <= 0:
+            return
+        expected = monotonic() + self.interval
+        while True:
+            await asyncio.sleep(self.interval)
+            now = monotonic()
+            self.update(max(0.0, now - expected), now)
+            expected = now + self.interval
+
+    def __str__(self):
+        return f'Loop lag - last: {round(self.last_lag * 1000, 3)}ms | {self.lag} | ' \
+               f'level: {self.LEVELS[self.level]} | entered: {dict(zip(self.LEVELS[1:], self.events[1:]))} | ' \
+               f'shed traces: {self.traces_shed} | buffered not extracted: {self.buffered_skipped} | ' \
+               f'deferred live packets: {self.live_deferred} (waiting: {len(self.deferred)}, ' \
+               f'dropped: {self.deferred_dropped})'
@@ -0,0 +1,221 @@
+"""
+Grott - metrics in the Prometheus text exposition format
+"""
+
+import re
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+from .packet import GrottPacketType
+from .stats import GrottHistogram
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_METRIC_NAME = re.compile(r'[a-zA-Z_:][a-zA-Z0-9_:]*')
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def packet_type_label(type_num: int) -> str:
+    """ LIVE_DATA, KEEP_ALIVE etc. Hex for the unknown types """
+    packet_type = GrottPacketType(type_num.to_bytes(2, 'big'))
+    return packet_type.name if packet_type != GrottPacketType.UNKNOWN else f'{type_num:04x}'
+
+
+class GrottExposition:
+    """
+    Text exposition writer. All samples of a metric must follow its family() call.
+
+    Examples:
+    >>> exp = GrottExposition()
+    >>> exp.family('grott_clients', 'gauge', 'Connected dataloggers')
+    >>> exp.sample('grott_clients', 12)
+    >>> exp.text()
+    """
+
+    def __init__(self):
+        self.lines: List[str] = []
+
+    def family(self, name: str, kind: str, description: str):
+        """
+        :param name: Metric name
+        :param kind: counter/gauge/histogram
+        :param description: HELP text
+        """
+        self.lines.append(f'# HELP {name} {description}')
+        self.lines.append(f'# TYPE {name} {kind}')
+
+    @staticmethod
+    def _labels(labels: Dict) -> str:
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+    def sample(self, name: str, value: float, **labels):
+        self.lines.append(f'{name}{self._labels(labels)} {value}')
+
+    def histogram(self, name: str, hist: GrottHistogram, **labels):
+        """ Cumulative buckets, _sum and _count of a GrottHistogram """
+        for bound, count in zip(hist.buckets + ('+Inf',), hist.cumulative()):
+            self.lines.append(f'{name}_bucket{self._labels(dict(labels, le=bound))} {count}')
+        self.lines.append(f'{name}_sum{self._labels(labels)} {hist.total}')
+        self.lines.append(f'{name}_count{self._labels(labels)} {hist.count}')
+
+    def text(self) -> str:
+        return '\n'.join(self.lines) + '\n'
+
+
+class GrottLoggerMetrics:
+    """ Counters and histograms of one datalogger. Updated by its ProxyClient """
+
+    __slots__ = ('serial', 'cl_frames', 'srv_frames', 'cl_bytes', 'srv_bytes', 'crc_errors', 'proc_dropped',
+                 'decode_time', 'forward_time', 'dispatch_time')
+
+    def __init__(self, serial: str):
+        self.serial = serial
+        self.cl_frames: Dict[int, int] = defaultdict(int)
+        """ Packet type -> frames from the datalogger """
+        self.srv_frames: Dict[int, int] = defaultdict(int)
+        """ Packet type -> frames from the server """
+        self.cl_bytes = 0
+        self.srv_bytes = 0
+        self.crc_errors = 0
+        self.proc_dropped = 0
+        """ Packets forwarded without processing (queue full) """
+        self.decode_time = GrottHistogram()
+        self.forward_time = GrottHistogram()
+        """ Data received from the datalogger -> written to the server """
+        self.dispatch_time = GrottHistogram()
+        """ MQTT/plugins hand-over of a decoded record """
+
+    def merge(self, other: 'GrottLoggerMetrics'):
+        for type_num, count in other.cl_frames.items():
+            self.cl_frames[type_num] += count
+        for type_num, count in other.srv_frames.items():
+            self.srv_frames[type_num] += count
+        self.cl_bytes += other.cl_bytes
+        self.srv_bytes += other.srv_bytes
+        self.crc_errors += other.crc_errors
+        self.proc_dropped += other.proc_dropped
+        self.decode_time.merge(other.decode_time)
+        self.forward_time.merge(other.forward_time)
+        self.dispatch_time.merge(other.dispatch_time)
+
+
+class GrottMetrics:
+    """
+    Metrics of a proxy process labelled by datalogger serial.
+
+    The per datalogger values are kept (for the dataloggers which reconnect)
+    in GrottLoggerMetrics. A new client counts in its own GrottLoggerMetrics
+    until its serial is known (or it disconnects) and is then adopted. The gauges and the metrics of the other components
+    are written by the collectors at render time.
+
+    Examples:
+    >>> metrics = GrottMetrics()
+    >>> metrics.collectors.append(proxy.collect_metrics)
+    >>> client_metrics = metrics.client()
+    >>> client_metrics.cl_frames[0x0104] += 1
+    >>> client_metrics = metrics.adopt(client_metrics, 'XGD1821A81')
+    >>> metrics.render()
+    """
+
+    UNKNOWN = 'unknown'
+    """ Label of the clients which have not sent their serial yet """
+
+    def __init__(self):
+        self.loggers: Dict[str, GrottLoggerMetrics] = {}
+        self.collectors: List[Callable[[GrottExposition], None]] = []
+
+    def logger(self, serial: str) -> GrottLoggerMetrics:
+        serial = serial or self.UNKNOWN
+        metrics = self.loggers.get(serial)
+        if metrics is None:
+            metrics = self.loggers[serial] = GrottLoggerMetrics(serial)
+        return metrics
+
+    def client(self) -> GrottLoggerMetrics:
+        """ Metrics of a new client. Not rendered before adopt() """
+        return GrottLoggerMetrics(self.UNKNOWN)
+
+    def adopt(self, metrics: GrottLoggerMetrics, serial: str) -> GrottLoggerMetrics:
+        """
+        Merge the metrics of a client into these of its datalogger
+
+        :param metrics: From client()
+        :param serial: Datalogger serial. Empty for the clients which have not sent it
+        :return: The metrics to be updated from now on
+        """
+        target = self.logger(serial)
+        if metrics is not target:
+            target.merge(metrics)
+        return target
+
+    def render(self) -> str:
+        exp = GrottExposition()
+        loggers = list(self.loggers.values())
+
+        exp.family('grott_frames_total', 'counter', 'Frames by packet type and direction')
+        for m in loggers:
+            for direction, frames in (('client', m.cl_frames), ('server', m.srv_frames)):
+                for type_num, count in sorted(frames.items()):
+                    exp.sample('grott_frames_total', count, logger=m.serial, direction=direction,
+                               type=packet_type_label(type_num))
+        exp.family('grott_bytes_total', 'counter', 'Bytes by direction')
+        for m in loggers:
+            exp.sample('grott_bytes_total', m.cl_bytes, logger=m.serial, direction='client')
+            exp.sample('grott_bytes_total', m.srv_bytes, logger=m.serial, direction='server')
+        exp.family('grott_crc_errors_total', 'counter', 'Datalogger packets with invalid CRC')
+        for m in loggers:
+            exp.sample('grott_crc_errors_total', m.crc_errors, logger=m.serial)
+        exp.family('grott_process_dropped_total', 'counter', 'Packets forwarded without processing (queue full)')
+        for m in loggers:
+            exp.sample('grott_process_dropped_total', m.proc_dropped, logger=m.serial)
+        for name, attr, description in (
+                ('grott_decode_seconds', 'decode_time', 'Decoding time of the data packets'),
+                ('grott_forward_seconds', 'forward_time', 'Datalogger data received -> written to the server'),
+                ('grott_dispatch_seconds', 'dispatch_time', 'Hand-over of a decoded record to MQTT and plugins')):
+            exp.family(name, 'histogram', description)
+            for m in loggers:
+                exp.histogram(name, getattr(m, attr), logger=m.serial)
+
+        for collector in self.collectors:
+            collector(exp)
+        return exp.text()
+
+
+def merge_expositions(texts: List[Tuple[str, str]], label: str = 'worker') -> str:
+    """
+    Single exposition from the expositions of several processes.
+    The samples get an extra label and are grouped by metric.
+
+    :param texts: (label value, exposition text)
+    :param label: Name of the extra label
+    """
+    headers: Dict[str, List[str]] = {}
+    samples: Dict[str, List[str]] = {}
+    for value, text in texts:
+        family = None
+        extra = f'{label}="{_escape(value)}"'
+        for line in text.splitlines():
+            if line.startswith('# '):
+                family = line.split(' ')[2]
+                family_headers = headers.setdefault(family, [])
+                if line not in family_headers:
+                    family_headers.append(line)
+                samples.setdefault(family, [])
+                continue
+            if not line or family is None:
+                continue
+            name = _METRIC_NAME.match(line).group(0)
+            rest = line[len(name):]
+            if rest.startswith('{'):
+                samples[family].append(f'{name}{{{extra},{rest[1:]}')
+            else:
+                samples[family].append(f'{name}{{{extra}}}{rest}')
+    lines = []
+    for family, family_headers in headers.items():
+        lines += family_headers
+        lines += samples[family]
+    return '\n'.join(lines) + '\n'
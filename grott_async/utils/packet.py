@@ -2,12 +2,15 @@
 Grott - packet utilities
 """
 
-from itertools import cycle
 from libscrc import modbus
 import struct
 from typing import List, Union
 import enum
 from .protocol_enums import Fault1, Fault8, Warn8
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 __DEBUG__ = True
@@ -22,6 +25,15 @@ class GrottConstants:
     HEADER_MAX_LEN = 158
     """ Length for packet in HEX format """
     PACKET_CRC = -2  # Last 2 bytes
+    HEADER_LEN = 6
+    """ Sequence No + Protocol version + Data length """
+    TYPE_LEN = 2
+    """ Packet type. Counted in the data length """
+    CRC_LEN = 2
+    CRC_PROTOCOLS = (5, 6)
+    """ Protocol versions with a CRC after the data (and masked data) """
+    MAX_FRAME = HEADER_LEN + 0xffff + CRC_LEN
+    """ The data length is a 16 bit field """
 
 
 class RegType:
@@ -99,6 +111,36 @@ def grott_crc_ok(packet: bytes) -> bool:
     return int(packet[-2:].hex(), 16) == crc
 
 
+_MASK_STREAM = (GrottConstants.MASK * (GrottConstants.MAX_FRAME // len(GrottConstants.MASK) + 1)
+                )[:GrottConstants.MAX_FRAME]
+""" The mask repeated over the max frame size. Computed once """
+_MASK_INT = int.from_bytes(_MASK_STREAM, 'little')
+""" Same keystream as an integer. The low N bytes are the mask for N bytes of data """
+_MASK_ARRAY = numpy.frombuffer(_MASK_STREAM, dtype=numpy.uint8) if numpy else None
+_NUMPY_MIN_LEN = 1024
+""" Below this size the integer path is faster than the numpy call overhead """
+
+
+def xor_mask(data: bytes) -> bytes:
+    """
+    Apply the Growatt mask to the provided bytes. Masking and unmasking
+    is the same operation.
+
+    The data is XOR-ed with the precomputed keystream as a single integer
+    (or as numpy array for large chunks if numpy is available)
+
+    :param data: Bytes to be (un)masked. Max length GrottConstants.MAX_FRAME
+    :type data: bytes
+    :return: (Un)masked bytes
+    :rtype: bytes
+    """
+    length = len(data)
+    if _MASK_ARRAY is not None and length >= _NUMPY_MIN_LEN:
+        return numpy.bitwise_xor(numpy.frombuffer(data, dtype=numpy.uint8), _MASK_ARRAY[:length]).tobytes()
+    masked = int.from_bytes(data, 'little') ^ (_MASK_INT & ((1 << (length << 3)) - 1))
+    return masked.to_bytes(length, 'little')
+
+
 def decrypt(packet: bytes) -> bytes:
     """
 
@@ -107,17 +149,9 @@ def decrypt(packet: bytes) -> bytes:
     :return: Decrypted packet
     :rtype: bytes
     """
-
-    packet = bytearray(packet)
-    unmask = cycle(GrottConstants.MASK)
-
-    decrypted = bytearray([x ^ next(unmask) for x in packet[GrottConstants.HEADER_PLAIN:GrottConstants.PACKET_CRC]])
-    dec_pack = packet[:GrottConstants.HEADER_PLAIN] + \
-        decrypted + \
-        packet[GrottConstants.PACKET_CRC:]
-
-    dec_pack = bytes(dec_pack)
-    return dec_pack
+    return bytes(packet[:GrottConstants.HEADER_PLAIN]) + \
+        xor_mask(packet[GrottConstants.HEADER_PLAIN:GrottConstants.PACKET_CRC]) + \
+        bytes(packet[GrottConstants.PACKET_CRC:])
 
 
 class GrottPacketType(bytes, enum.Enum):
@@ -148,26 +182,76 @@ class GrottPacketType(bytes, enum.Enum):
         return 'GrottPacket.' + self.name
 
 
+_PACKET_TYPES = {struct.unpack('>H', x.value)[0]: x for x in GrottPacketType}
+""" Packet type number -> GrottPacketType """
+_HEADER = struct.Struct('>HHHH')
+""" Sequence No, Protocol version, Data length, Packet type """
+_CRC = struct.Struct('>H')
+
+FORWARD_ONLY_TYPES = frozenset(struct.unpack('>H', x.value)[0] for x in (GrottPacketType.KEEP_ALIVE,
+                                                                          GrottPacketType.SET_TIME,
+                                                                          GrottPacketType.DATALOGGER_CONFIG,
+                                                                          GrottPacketType.DATALOGGER_REPORT))
+""" Packet type numbers which are only forwarded (never decoded) """
+DATA_TYPES = frozenset(struct.unpack('>H', x.value)[0] for x in (GrottPacketType.INVERTER_REPORT,
+                                                                  GrottPacketType.LIVE_DATA,
+                                                                  GrottPacketType.BUFFERED_DATA))
+""" Packet type numbers acknowledged by the Growatt server """
+KEEP_ALIVE_TYPE = struct.unpack('>H', GrottPacketType.KEEP_ALIVE.value)[0]
+
+
+def packet_type_of(frame: Union[bytes, memoryview]) -> int:
+    """
+    Packet type number from the header bytes [6:8] without creating a packet
+
+    :param frame: Raw packet
+    :return: 0 for frames shorter than the header
+    """
+    if len(frame) < GrottConstants.HEADER_PLAIN:
+        return 0
+    return frame[6] << 8 | frame[7]
+
+
 class GrottRawPacket:
+    """
+    Light view over a Growatt packet.
+
+    The header is unpacked in a single pass. Everything else (packet type, CRC
+    check, decryption) is evaluated on first access and cached, so frames which
+    are only forwarded cost next to nothing.
+    """
 
-    def __init__(self, packet: bytes):
+    __slots__ = ('packet', 'seq_no', 'protocol_version', 'data_length', 'packet_type_num',
+                 '_packet_type', '_crc_ok', '_decrypted')
+
+    def __init__(self, packet: Union[bytes, memoryview]):
         """
         :param packet: Raw packet as received on the socket
-        :type packet: bytes
+        :type packet: bytes | memoryview
         """
         self.packet = packet
-        self.seq_no = int(self.packet[:2].hex(), 16)
-        self.data_length = int(self.packet[4:6].hex(), 16)
-        self.protocol_version = int(self.packet[2:4].hex(), 16)
-        self.packet_crc = int(self.packet[-2:].hex(), 16)
-        self.packet_type_num = int(self.packet[6:8].hex(), 16)  # Packet type as integer
-        self.packet_type = GrottPacketType(self.packet[6:8])
+        self.seq_no, self.protocol_version, self.data_length, self.packet_type_num = _HEADER.unpack_from(packet)
+        self._packet_type = None
+        self._crc_ok = None
         self._decrypted = None
 
+    @property
+    def packet_type(self) -> GrottPacketType:
+        if self._packet_type is None:
+            self._packet_type = _PACKET_TYPES.get(self.packet_type_num, GrottPacketType.UNKNOWN)
+        return self._packet_type
+
+    @property
+    def packet_crc(self) -> int:
+        """ CRC as found in the packet """
+        return _CRC.unpack_from(self.packet, len(self.packet) - GrottConstants.CRC_LEN)[0]
+
     @property
     def valid_crc(self) -> bool:
         """ Packet CRC """
-        return grott_crc_ok(self.packet)
+        if self._crc_ok is None:
+            self._crc_ok = modbus(self.packet[:GrottConstants.PACKET_CRC]) == self.packet_crc
+        return self._crc_ok
 
     @property
     def valid_length(self) -> bool:
@@ -176,7 +260,7 @@ class GrottRawPacket:
 
     @property
     def needs_decryption(self) -> bool:
-        return self.protocol_version in [5, 6]
+        return self.protocol_version in GrottConstants.CRC_PROTOCOLS
 
     @property
     def datalogger_serial(self) -> bytes:
@@ -211,14 +295,12 @@ class GrottRawPacket:
         :return:
         :rtype:
         """
-        if self.needs_decryption:
-            if self._decrypted:
-                return self._decrypted
-            else:
+        if self._decrypted is None:
+            if self.needs_decryption:
                 self._decrypted = decrypt(self.packet)
-                return self._decrypted
-        else:
-            return self.packet
+            else:
+                self._decrypted = bytes(self.packet)
+        return self._decrypted
 
     def __str__(self):
         return f'''
@@ -235,7 +317,7 @@ class GrottRawPacket:
         Datalogger:     {self.datalogger_serial}
         Inverter:       {self.inverter_serial}
         ----------------------------------------
-        {self.packet}
+        {bytes(self.packet)}
         
         ----
         
@@ -1,8 +1,7 @@
 import random
 import struct
-from .packet import GrottConstants, GrottPacketType
+from .packet import GrottConstants, GrottPacketType, xor_mask
 from libscrc import modbus
-from itertools import cycle
 from typing import Union
 
 
@@ -14,12 +13,7 @@ def encrypt(packet: bytes) -> bytes:
     :return: Encrypted bytes
     """
 
-    packet = bytearray(packet)
-    mask = cycle(GrottConstants.MASK)
-
-    encrypted = bytearray([x ^ next(mask) for x in packet])
-    pack = bytes(encrypted)
-    return pack
+    return xor_mask(packet)
 
 
 class RegisterReq:
@@ -108,4 +102,18 @@ class ReadHoldingV6(RegisterReq):
         self.data_sep = 20
 
 
+def data_ack(frame: Union[bytes, memoryview]) -> bytes:
+    """
+    Acknowledgement of a data packet (03/04/50) as sent by the Growatt server.
+    Used when the server is not reachable and the packet was spooled
 
+    :param frame: The packet to acknowledge
+    :return: Ack with the same sequence No, protocol and packet type. With a CRC for the protocols 5/6 only
+             (same rule as GrottFrameBuffer.frame_length)
+    """
+    header = bytes(frame[0:4]) + b'\x00\x03' + bytes(frame[6:8])
+    proto = struct.unpack('>H', header[2:4])[0]
+    if proto in GrottConstants.CRC_PROTOCOLS:
+        packet = header + b'\x47'
+        return packet + struct.pack('>H', modbus(packet))
+    return header + b'\x00'
@@ -0,0 +1,116 @@
+"""
+Grott - idle connections reaper
+"""
+
+import asyncio
+import logging
+from heapq import heappush, heappop
+from itertools import count
+from time import monotonic
+from typing import Callable, Dict, Hashable, List, Tuple
+
+log = logging.getLogger('grott')
+
+
+class GrottIdleReaper:
+    """
+    Single sweeper for the idle timeouts of all connections.
+
+    The connections only record the time of their last activity (time.monotonic)
+    and no timer is created per read. The deadlines are kept in a heap and are
+    checked lazily - an entry which was active in the meantime is pushed back with
+    its new deadline. All connections expired at a sweep are closed together.
+
+    Examples:
+    >>> reaper = GrottIdleReaper()
+    >>> loop.create_task(reaper.run())
+    >>> reaper.watch(peer, 600, lambda: client.last_read, client.writer.close)
+    >>> reaper.forget(peer)
+    """
+
+    def __init__(self, resolution: float = 1.0):
+        """
+        :param resolution: Minimum time between two sweeps (seconds)
+        """
+        self.resolution = resolution
+        self.expired = 0
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._entries: Dict[Hashable, Tuple[float, Callable[[], float], Callable[[], None], int]] = {}
+        """ key -> (limit, last activity, on expire, sequence No of the heap entry) """
+        self._seq = count()
+        self._wakeup: asyncio.Event = None  # noqa
+
+    def watch(self, key: Hashable, limit: float, activity: Callable[[], float], on_expire: Callable[[], None]):
+        """
+        Start watching a connection. A watched key is replaced.
+
+        :param key: Unique key of the connection
+        :param limit: Max idle time (seconds). 0 disables the watch
+        :param activity: Returns the time (monotonic) of the last activity
+        :param on_expire: Called (once) when the connection has been idle for limit seconds
+        """
+        if not limit or limit <= 0:
+            self._entries.pop(key, None)
+            return
+        seq = next(self._seq)
+        self._entries[key] = (limit, activity, on_expire, seq)
+        deadline = activity() + limit
+        heappush(self._heap, (deadline, seq, key))
+        if self._wakeup is not None and self._heap[0][1] == seq:
+            """ Earlier than the deadline the sweeper is waiting for """
+            self._wakeup.set()
+
+    def forget(self, key: Hashable):
+        """ Stop watching. The heap entry is dropped on its deadline """
+        self._entries.pop(key, None)
+
+    def sweep(self) -> int:
+        """
+        Expire all connections idle for more than their limit
+
+        :return: Expired connections
+        """
+        now = monotonic()
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, seq, key = heappop(heap)
+            entry = self._entries.get(key)
+            if entry is None or entry[3] != seq:
+                """ Forgotten or replaced """
+                continue
+            limit, activity, on_expire, _ = entry
+            deadline = activity() + limit
+            if deadline <= now:
+                del self._entries[key]
+                expired.append((key, on_expire))
+            else:
+                heappush(heap, (deadline, seq, key))
+
+        for key, on_expire in expired:
+            try:
+                on_expire()
+            except Exception as e:
+                log.exception(f'[IdleReaper] {key} expire error: {e}')
+        self.expired += len(expired)
+        return len(expired)
+
+    async def run(self):
+        """ The sweeper task """
+        self._wakeup = asyncio.Event()
+        while True:
+            timeout = None
+            if self._heap:
+                timeout = max(self._heap[0][0] - monotonic(), self.resolution)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.sweep()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return f'Idle reaper: watched {len(self._entries)} | expired {self.expired} | heap {len(self._heap)}'
@@ -0,0 +1,38 @@
+"""
+Grott - extracted data record
+"""
+
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+
+class GrottRecord(dict):
+    """
+    Data extracted from a packet.
+
+    A plain dict for the plugins, with a compact JSON form which is encoded on first
+    use and shared by all sinks (MQTT, plugins, logs). The record must not be modified
+    once it is handed to the sinks.
+
+    Examples:
+    >>> record = GrottRecord({'device': 'RJE3A22419', 'values': {}})
+    >>> record.json()
+    b'{"device":"RJE3A22419","values":{}}'
+    """
+
+    __slots__ = ('_json',)
+
+    def __init__(self, *args, **kwargs):
+        super(GrottRecord, self).__init__(*args, **kwargs)
+        self._json = None
+
+    def json(self) -> bytes:
+        """ Compact JSON (orjson if available). Encoded once """
+        if self._json is None:
+            if json.__name__ == 'orjson':
+                self._json = json.dumps(self)
+            else:
+                self._json = json.dumps(self, separators=(',', ':')).encode()
+        return self._json
@@ -0,0 +1,94 @@
+"""
+Grott - connected clients registry
+"""
+
+import logging
+from typing import Dict, Iterator, List, Optional, Tuple
+
+log = logging.getLogger('grott')
+
+
+class GrottClientRegistry:
+    """
+    The clients of the proxy by id with indexes by datalogger and inverter serial.
+
+    The clients are registered on accept (unique id) and indexed when their
+    serials are known. A datalogger has a single entry - when it connects again
+    the new client takes the place of the old one.
+
+    The clients must have the attributes id, logger_serial, inverter_serial and
+    proto_version (see ProxyClient).
+
+    Examples:
+    >>> registry = GrottClientRegistry()
+    >>> registry.add(client)
+    >>> stale = registry.identified(client)
+    >>> registry.by_logger('XGD1821A81') is client
+    True
+    >>> registry.remove(client)
+    """
+
+    def __init__(self):
+        self._by_id: Dict[int, object] = {}
+        self._by_logger: Dict[str, object] = {}
+        self._by_inverter: Dict[str, object] = {}
+        self._listing: Optional[List[Tuple[str, str, int]]] = None
+        """ Cached list_clients() result. Dropped on every change """
+        self.replaced = 0
+
+    def add(self, client):
+        self._by_id[client.id] = client
+        self._listing = None
+
+    def identified(self, client) -> Optional[object]:
+        """
+        Index a client by its serials (once they are known)
+
+        :return: The previous client of the same datalogger (to be closed) or None
+        """
+        stale = None
+        if client.logger_serial:
+            stale = self._by_logger.get(client.logger_serial)
+            if stale is client:
+                stale = None
+            elif stale is not None:
+                self.replaced += 1
+            self._by_logger[client.logger_serial] = client
+        if client.inverter_serial:
+            self._by_inverter[client.inverter_serial] = client
+        self._listing = None
+        return stale
+
+    def remove(self, client):
+        """ The indexes are kept if they already point to a newer client """
+        self._by_id.pop(client.id, None)
+        if self._by_logger.get(client.logger_serial) is client:
+            del self._by_logger[client.logger_serial]
+        if self._by_inverter.get(client.inverter_serial) is client:
+            del self._by_inverter[client.inverter_serial]
+        self._listing = None
+
+    def get(self, client_id: int):
+        return self._by_id.get(client_id)
+
+    def by_logger(self, logger_serial: str):
+        return self._by_logger.get(logger_serial)
+
+    def by_inverter(self, inverter_serial: str):
+        return self._by_inverter.get(inverter_serial)
+
+    def listing(self) -> List[Tuple[str, str, int]]:
+        """ (datalogger serial, inverter serial, protocol version) of all clients. Must not be modified """
+        if self._listing is None:
+            self._listing = [(x.logger_serial, x.inverter_serial, x.proto_version) for x in self._by_id.values()]
+        return self._listing
+
+    def __iter__(self) -> Iterator:
+        return iter(list(self._by_id.values()))
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __str__(self):
+        return f'Clients: {len(self._by_id)} | dataloggers: {len(self._by_logger)} | ' \
+               f'inverters: {len(self._by_inverter)} | replaced: {self.replaced}'
@@ -0,0 +1,106 @@
+"""
+Grott - on-disk spool for store-and-forward
+"""
+
+import os
+from typing import Optional, Union
+from .packet import GrottConstants
+from .framer import GrottFrameBuffer
+
+
+class GrottSpool:
+    """
+    Bounded on-disk FIFO with the frames of a single datalogger.
+
+    The frames are appended as they are (the Growatt frames carry their own
+    length), so the file is a copy of the stream which could not be forwarded.
+    The frames already replayed are removed from the file on close. Frames
+    replayed before a crash will be replayed again.
+
+    Examples:
+    >>> spool = GrottSpool('spool', 'XGD1821A81', 10 * 1024 ** 2)
+    >>> spool.append(frame)
+    >>> frame = spool.peek()
+    >>> writer.write(frame)
+    >>> spool.pop(len(frame))
+    """
+
+    def __init__(self, directory: str, name: str, max_size: int):
+        """
+        :param directory: Spool directory (created if missing)
+        :param name: File name (datalogger serial)
+        :param max_size: Max file size in bytes. New frames are dropped when full
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'{name}.spool')
+        self.max_size = max_size
+        self._file = open(self.path, 'a+b')
+        self._file.seek(0, os.SEEK_END)
+        self.size = self._file.tell()
+        self.offset = 0
+        """ Start of the first frame not replayed yet """
+        self.stored = 0
+        self.dropped = 0
+        self.replayed = 0
+
+    @property
+    def pending(self) -> int:
+        """ Bytes waiting to be replayed """
+        return self.size - self.offset
+
+    def append(self, frame: Union[bytes, memoryview]) -> bool:
+        """
+        :return: False if the spool is full (the frame is dropped)
+        """
+        if self.size + len(frame) > self.max_size:
+            self.dropped += 1
+            return False
+        self._file.write(frame)
+        self.size += len(frame)
+        self.stored += 1
+        return True
+
+    def peek(self) -> Optional[bytes]:
+        """ The oldest frame. It stays in the spool until pop() """
+        if not self.pending:
+            return None
+        self._file.flush()
+        self._file.seek(self.offset)
+        header = self._file.read(GrottConstants.HEADER_LEN)
+        frame_len = 0
+        if len(header) == GrottConstants.HEADER_LEN:
+            frame_len = GrottFrameBuffer.frame_length(memoryview(header), 0)
+        if frame_len - GrottConstants.HEADER_LEN < GrottConstants.TYPE_LEN \
+                or self.offset + frame_len > self.size:
+            """ Truncated/corrupted file. Nothing after this point can be trusted """
+            self.clear()
+            return None
+        return header + self._file.read(frame_len - GrottConstants.HEADER_LEN)
+
+    def pop(self, frame_len: int):
+        """ Remove the oldest frame (already replayed) """
+        self.offset += frame_len
+        self.replayed += 1
+        if self.offset >= self.size:
+            self.clear()
+
+    def clear(self):
+        self._file.truncate(0)
+        self.size = 0
+        self.offset = 0
+
+    def close(self):
+        """ Keep only the frames which were not replayed """
+        if self.offset:
+            self._file.flush()
+            self._file.seek(self.offset)
+            rest = self._file.read()
+            self._file.truncate(0)
+            self._file.write(rest)
+        self._file.close()
+        if self.size == 0:
+            os.remove(self.path)
+
+    def __str__(self):
+        return f'Spool {self.path}: pending {self.pending}B | stored: {self.stored} | ' \
+               f'replayed: {self.replayed} | dropped: {self.dropped}'
@@ -0,0 +1,61 @@
+"""
+Grott - runtime statistics helpers
+"""
+
+from bisect import bisect_left
+from typing import List, Sequence
+
+
+class GrottHistogram:
+    """
+    Histogram with fixed buckets (upper bounds, in seconds).
+
+    Examples:
+    >>> hist = GrottHistogram()
+    >>> hist.observe(0.002)
+    >>> hist.count, hist.max
+    (1, 0.002)
+    """
+
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+    __slots__ = ('buckets', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)
+        """ The last one is for values above the highest bound (+Inf) """
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: 'GrottHistogram'):
+        """ Add the observations of another histogram (with the same buckets) """
+        self.counts = [x + y for x, y in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    @property
+    def avg(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def cumulative(self) -> List[int]:
+        """ Counts per bucket including all lower buckets (Prometheus style) """
+        result = []
+        running = 0
+        for cnt in self.counts:
+            running += cnt
+            result.append(running)
+        return result
+
+    def __str__(self):
+        return f'n: {self.count} | avg: {round(self.avg * 1000, 3)}ms | max: {round(self.max * 1000, 3)}ms'
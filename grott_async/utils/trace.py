@@ -0,0 +1,72 @@
+"""
+Grott - sampled debug tracing
+"""
+
+import logging
+import sys
+
+TRACE_LOGGER = 'grott-trace'
+""" Logger of the trace file (see trace_file in the config). Not a child of 'grott' """
+
+_CALLER = {'stacklevel': 2} if sys.version_info >= (3, 8) else {}
+""" Module/function of the caller in the debug format """
+
+
+class GrottTracer:
+    """
+    Debug traces (packet dumps, detected registers, decoded records) of one datalogger.
+
+    Nothing is built when the traces are disabled - the callers check the
+    cached flags before creating the messages. The traces are written to the
+    trace file if configured, otherwise to the log of the datalogger (at debug level).
+
+    Examples:
+    >>> tracer = GrottTracer(log, sample=10)
+    >>> if tracer.sampled(server=False):
+    ...     tracer.trace('%s <detected registers>: %s', parsed.inverter.name, parsed.registers)
+    """
+
+    def __init__(self, log: logging.Logger, sample: int = 1, monitor=None):
+        """
+        :param log: The log of the datalogger
+        :param sample: Trace 1 in <sample> packets
+        :param monitor: GrottLoopMonitor. No traces while it sheds them
+        """
+        self.log = log
+        self.monitor = monitor
+        self.sample = max(1, sample)
+        sink = logging.getLogger(TRACE_LOGGER)
+        self.sink = sink if sink.handlers else None
+        self.enabled = self.sink is not None or log.isEnabledFor(logging.DEBUG)
+        """ isEnabledFor() of the log (or a trace file) cached on creation """
+        self.traced = 0
+        self._skipped = [0, 0]
+        """ Packets since the last trace - from the datalogger, from the server """
+
+    def sampled(self, server: bool = False) -> bool:
+        """
+        Called once per packet. True if this packet has to be traced
+
+        :param server: The packet is from the server (sampled separately)
+        """
+        if not self.enabled:
+            return False
+        skipped = self._skipped
+        skipped[server] += 1
+        if skipped[server] < self.sample:
+            return False
+        skipped[server] = 0
+        if self.monitor is not None and self.monitor.shed_traces:
+            self.monitor.traces_shed += 1
+            return False
+        self.traced += 1
+        return True
+
+    def trace(self, msg, *args):
+        """ The message is formatted by the log thread (see GrottLogPipeline) """
+        if self.sink is None:
+            self.log.debug(msg, *args, **_CALLER)
+        elif args:
+            self.sink.debug('[%s] ' + msg, self.log.name, *args, **_CALLER)
+        else:
+            self.sink.debug('[%s] %s', self.log.name, msg, **_CALLER)
@@ -0,0 +1,220 @@
+"""
+Grott - connections to the Growatt server
+"""
+
+import asyncio
+import logging
+import random
+import socket
+from collections import deque
+from time import monotonic, perf_counter
+from typing import Deque, List, Tuple, Union
+from .stats import GrottHistogram
+
+log = logging.getLogger('grott')
+
+
+class GrottUpstreamConnector:
+    """
+    Opens the connections of all clients to the Growatt server.
+
+    - the address is resolved once per <dns_ttl> seconds (the last known
+      address is used if the resolver fails)
+    - optional: <pool_size> connected sockets are kept ready for the new
+      clients and replaced after <pool_max_age> seconds
+    - after a failure the pool is not refilled for a jittered, exponentially
+      growing delay (up to <backoff_max> seconds). A client never waits for
+      the backoff - it gets a ready socket or a direct connect attempt
+
+    Examples:
+    >>> connector = GrottUpstreamConnector('server.growatt.com', 5279)
+    >>> loop.create_task(connector.run())
+    >>> sock = await connector.connect()
+    >>> reader, writer = await asyncio.open_connection(sock=sock)
+    """
+
+    backoff_base = 1.0
+    """ Delay after the first failure (seconds) """
+
+    def __init__(self, host: str, port: Union[int, str], pool_size: int = 0, pool_max_age: float = 60,
+                 dns_ttl: float = 300, backoff_max: float = 60):
+        """
+        :param host: Growatt server
+        :param port: Growatt server port
+        :param pool_size: Connected sockets kept ready. 0 (default) disables the pool
+        :param pool_max_age: Seconds before a ready socket is replaced
+        :param dns_ttl: Seconds before the address is resolved again
+        :param backoff_max: Max delay of the pool refill after failed connects (seconds)
+        """
+        self.host = host
+        self.port = int(port)
+        self.pool_size = pool_size
+        self.pool_max_age = pool_max_age
+        self.dns_ttl = dns_ttl
+        self.backoff_max = backoff_max
+        self.connect_time = GrottHistogram()
+        self.connects = 0
+        self.failures = 0
+        """ Failed connects (clients and pool) """
+        self.pool_hits = 0
+        self.pool_stale = 0
+        """ Ready sockets closed by the server or too old """
+        self.dns_lookups = 0
+        self._addresses: List[Tuple] = []
+        self._resolved = 0.0
+        self._pool: Deque[Tuple[socket.socket, float]] = deque()
+        self._attempt = 0
+        """ Consecutive failures """
+        self._retry_at = 0.0
+        self._refill: asyncio.Event = None  # noqa
+
+    def retry_delay(self, attempt: int, cap: float = None) -> float:
+        """
+        Exponential backoff with jitter (half of the delay is random)
+
+        :param attempt: Consecutive failures (1 - after the first one)
+        :param cap: Max delay. backoff_max by default
+        """
+        cap = self.backoff_max if cap is None else cap
+        delay = min(cap, self.backoff_base * 2 ** max(attempt - 1, 0))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @property
+    def in_backoff(self) -> bool:
+        return monotonic() < self._retry_at
+
+    async def resolve(self) -> List[Tuple]:
+        """ getaddrinfo() results for the server. Cached for dns_ttl seconds """
+        if self._addresses and monotonic() - self._resolved < self.dns_ttl:
+            return self._addresses
+        self.dns_lookups += 1
+        try:
+            addresses = await asyncio.get_running_loop().getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+        except OSError as e:
+            if not self._addresses:
+                raise
+            log.error(f'[Upstream] Cannot resolve {self.host}: {e}. Using {self._addresses[0][4]}')
+            self._resolved = monotonic()
+            return self._addresses
+        self._addresses = addresses
+        self._resolved = monotonic()
+        return addresses
+
+    async def _open(self) -> socket.socket:
+        """ New connection to the first reachable address """
+        loop = asyncio.get_running_loop()
+        error = None
+        for family, type_, proto, _, address in await self.resolve():
+            sock = socket.socket(family, type_, proto)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, address)
+                return sock
+            except OSError as e:
+                sock.close()
+                error = e
+            except BaseException:
+                sock.close()
+                raise
+        raise error if error else OSError(f'No address for {self.host}')
+
+    async def _connect(self) -> socket.socket:
+        """ _open() with the latency and failure accounting """
+        _start = perf_counter()
+        try:
+            sock = await self._open()
+        except OSError:
+            self.failures += 1
+            self._attempt += 1
+            self._retry_at = monotonic() + self.retry_delay(self._attempt)
+            raise
+        self.connect_time.observe(perf_counter() - _start)
+        self.connects += 1
+        if self._attempt:
+            """ The server is back. Refill the pool without waiting for the backoff """
+            self._attempt = 0
+            self._retry_at = 0.0
+            if self._refill is not None:
+                self._refill.set()
+        return sock
+
+    def _take(self) -> Union[socket.socket, None]:
+        """ A ready socket which is still open """
+        now = monotonic()
+        while self._pool:
+            sock, opened = self._pool.popleft()
+            if now - opened < self.pool_max_age and self._alive(sock):
+                return sock
+            self.pool_stale += 1
+            sock.close()
+        return None
+
+    @staticmethod
+    def _alive(sock: socket.socket) -> bool:
+        """ Nothing is expected from the server before the datalogger has sent something """
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+            return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    async def connect(self) -> socket.socket:
+        """
+        Connected non-blocking socket for a client
+
+        :raise OSError: The server is not reachable
+        """
+        sock = self._take()
+        if self._refill is not None and len(self._pool) < self.pool_size:
+            self._refill.set()
+        if sock is not None:
+            self.pool_hits += 1
+            return sock
+        return await self._connect()
+
+    async def run(self):
+        """ Keeps the pool filled. Returns at once if the pool is disabled """
+        if self.pool_size <= 0:
+            return
+        self._refill = asyncio.Event()
+        try:
+            while True:
+                self._refill.clear()
+                await self._fill()
+                timeout = self.pool_max_age
+                if self.in_backoff:
+                    timeout = min(timeout, self._retry_at - monotonic())
+                try:
+                    await asyncio.wait_for(self._refill.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.close()
+
+    async def _fill(self):
+        now = monotonic()
+        while self._pool and now - self._pool[0][1] >= self.pool_max_age:
+            self.pool_stale += 1
+            self._pool.popleft()[0].close()
+        while len(self._pool) < self.pool_size:
+            if self.in_backoff:
+                """ Retried by run() after the backoff (or a successful client connect) """
+                return
+            try:
+                sock = await self._connect()
+            except OSError as e:
+                log.debug(f'[Upstream] Pool connect failed: {e}')
+                continue
+            self._pool.append((sock, monotonic()))
+
+    def close(self):
+        while self._pool:
+            self._pool.popleft()[0].close()
+
+    def __str__(self):
+        return f'Upstream {self.host}:{self.port} - connects: {self.connects} | failures: {self.failures} | ' \
+               f'pool: {len(self._pool)}/{self.pool_size} ' \
+               f'(hits: {self.pool_hits}, stale: {self.pool_stale}) | dns lookups: {self.dns_lookups} | ' \
+               f'connect time {self.connect_time}'
@@ -0,0 +1,149 @@
+"""
+Grott proxy - multi-process mode
+
+N worker processes run their own AsyncProxyServer on the same port (SO_REUSEPORT),
+so the kernel spreads the datalogger connections over all of them. The supervisor
+restarts crashed workers and serves the command socket for all workers.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from time import monotonic
+from typing import Dict
+from .utils import GrottProxyConfig, GrottLogger, setup_event_loop, TRACE_LOGGER
+from .grottproxy_async import AsyncProxyServer
+from .extras.command_socket import GrottCMDRouter, worker_cmd_port
+from .extras.metrics_server import GrottMetricsServer
+
+log = logging.getLogger('grott')
+
+
+def worker_log_file(log_file: str, worker_id: int) -> str:
+    """ grott_async.log -> grott_async.w0.log """
+    root, ext = os.path.splitext(log_file)
+    return f'{root}.w{worker_id}{ext}'
+
+
+def _worker_main(config_file: str, worker_id: int, event_loop: str):
+    """ Entry point of a worker process """
+    config = GrottProxyConfig(config_file)
+    logger = GrottLogger(output=config.log_to, level=config.log_level,
+                         fname=worker_log_file(config.log_file, worker_id), queue_size=config.log_queue)
+    if config.trace_file:
+        trace_logger = GrottLogger(output='file', level='debug', fname=worker_log_file(config.trace_file, worker_id),
+                                   logger_name=TRACE_LOGGER)
+    setup_event_loop(event_loop)
+    config.load_plugins()
+    proxy = AsyncProxyServer(config, worker_id=worker_id)
+    asyncio.run(proxy.main())
+
+
+class GrottWorkerSupervisor:
+    """
+    Start and supervise the worker processes.
+
+    Examples:
+    >>> supervisor = GrottWorkerSupervisor('grott_async.ini', 4)
+    >>> asyncio.run(supervisor.main())
+    """
+
+    check_interval = 1
+    """ Seconds between the worker checks """
+    min_uptime = 10
+    """ Workers exiting before this (seconds) are restarted with a growing delay """
+    max_restart_delay = 60
+    stop_timeout = 10
+    """ Seconds to wait for the workers to exit before killing them """
+
+    def __init__(self, config_file: str, workers: int, event_loop: str = 'auto'):
+        """
+        :param config_file: INI file used by all workers
+        :param workers: Number of worker processes
+        :param event_loop: Event loop of the workers (auto/uvloop/asyncio)
+        """
+        self.config_file = config_file
+        self.workers = workers
+        self.event_loop = event_loop
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self.started: Dict[int, float] = {}
+        self.restart_delay: Dict[int, float] = {}
+        self.restarts = 0
+        self.cmd_router = GrottCMDRouter([worker_cmd_port(x) for x in range(workers)])
+        self._ctx = multiprocessing.get_context('spawn')
+        """ Clean interpreter for every worker (no inherited event loop or threads) """
+        self._stopping = False
+        self._stop: asyncio.Event = None  # noqa
+
+    def _spawn(self, worker_id: int):
+        if self._stopping:
+            return
+        proc = self._ctx.Process(target=_worker_main, args=(self.config_file, worker_id, self.event_loop),
+                                 name=f'grott-worker-{worker_id}')
+        proc.start()
+        self.processes[worker_id] = proc
+        self.started[worker_id] = monotonic()
+        log.info(f'[Supervisor] Worker {worker_id} started. PID [{proc.pid}]')
+
+    def _check_workers(self):
+        loop = asyncio.get_running_loop()
+        for worker_id, proc in list(self.processes.items()):
+            if proc.is_alive():
+                continue
+            self.processes.pop(worker_id)
+            uptime = monotonic() - self.started[worker_id]
+            if uptime < self.min_uptime:
+                delay = min(self.restart_delay.get(worker_id, 0.5) * 2, self.max_restart_delay)
+            else:
+                delay = 1
+            self.restart_delay[worker_id] = delay
+            self.restarts += 1
+            log.error(f'[Supervisor] Worker {worker_id} exited with code {proc.exitcode} '
+                      f'after {round(uptime, 1)}s. Restarting in {delay}s')
+            loop.call_later(delay, self._spawn, worker_id)
+
+    def stop(self, *args):
+        log.info('[Supervisor] Stopping the workers')
+        self._stopping = True
+        for proc in self.processes.values():
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGINT)
+        self._stop.set()
+
+    async def _wait_workers(self):
+        deadline = monotonic() + self.stop_timeout
+        while monotonic() < deadline and any(x.is_alive() for x in self.processes.values()):
+            await asyncio.sleep(0.1)
+        for worker_id, proc in self.processes.items():
+            if proc.is_alive():
+                log.error(f'[Supervisor] Worker {worker_id} did not stop. Killing it')
+                proc.kill()
+            proc.join()
+
+    async def main(self):
+        self._stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+        log.info(f'Grott async proxy supervisor - PID [{os.getpid()}] | workers: {self.workers}')
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+        router = loop.create_task(self.cmd_router.start())
+        config = GrottProxyConfig(self.config_file)
+        metrics = None
+        if config.metrics_port:
+            """ Single scrape target for all workers """
+            metrics_server = GrottMetricsServer(self.cmd_router.metrics_all, config.metrics_address, config.metrics_port)
+            metrics = loop.create_task(metrics_server.start())
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._stop.wait(), self.check_interval)
+            except asyncio.TimeoutError:
+                self._check_workers()
+        router.cancel()
+        if metrics:
+            metrics.cancel()
+        await self._wait_workers()
+        log.info(f'[Supervisor] All workers stopped. Restarts: {self.restarts}')
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+
+from grott_async.utils.spool import GrottSpool
+
+
+def frame(protocol: int, data: bytes) -> bytes:
+    """ seq + protocol + length + type/data (+ CRC for the protocols 5/6) """
+    packet = b'\x00\x01' + protocol.to_bytes(2, 'big') + len(data).to_bytes(2, 'big') + data
+    if protocol in (5, 6):
+        packet += b'\xaa\xbb'
+    return packet
+
+
+class TestSpoolReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.spool = GrottSpool(self.tmp.name, 'TEST', 1024)
+
+    def tearDown(self):
+        self.spool.close()
+        self.tmp.cleanup()
+
+    def replay(self):
+        frames = []
+        while True:
+            packet = self.spool.peek()
+            if packet is None:
+                return frames
+            frames.append(packet)
+            self.spool.pop(len(packet))
+
+    def test_protocol_2(self):
+        frames = [frame(2, b'\x01\x04' + b'\x11' * 10), frame(2, b'\x01\x16' + b'\x22' * 4)]
+        for packet in frames:
+            self.spool.append(packet)
+        self.assertEqual(self.replay(), frames)
+        self.assertEqual(self.spool.replayed, 2)
+
+    def test_protocol_5_6(self):
+        frames = [frame(5, b'\x01\x04' + b'\x11' * 10), frame(6, b'\x01\x50' + b'\x22' * 7)]
+        for packet in frames:
+            self.spool.append(packet)
+        self.assertEqual(self.replay(), frames)
+
+    def test_mixed(self):
+        frames = [frame(6, b'\x01\x04' + b'\x11' * 3), frame(2, b'\x01\x16\x47'),
+                  frame(5, b'\x01\x03'), frame(2, b'\x01\x04' + b'\x33' * 20)]
+        for packet in frames:
+            self.spool.append(packet)
+        self.assertEqual(self.replay(), frames)
+
+    def test_truncated(self):
+        packet = frame(6, b'\x01\x04' + b'\x11' * 10)
+        self.spool.append(packet)
+        self.spool.append(packet[:-3])
+        self.assertEqual(self.replay(), [packet])
+        self.assertEqual(self.spool.pending, 0)
+
+    def test_kept_on_close(self):
+        frames = [frame(2, b'\x01\x04\x01'), frame(2, b'\x01\x04\x02')]
+        for packet in frames:
+            self.spool.append(packet)
+        self.spool.pop(len(self.spool.peek()))
+        self.spool.close()
+        self.spool = GrottSpool(self.tmp.name, 'TEST', 1024)
+        self.assertEqual(self.replay(), frames[1:])
+
+
+if __name__ == '__main__':
+    unittest.main()